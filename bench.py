@@ -0,0 +1,317 @@
+"""Нагрузочный тест бота.
+
+Запускает настоящий Application с обработчиками из bot.py против локальной
+заглушки Telegram Bot API и локальной базы данных (DATABASE_URL или SQLite при
+STORAGE_BACKEND=sqlite), генерирует
+смесь апдейтов от виртуальных пользователей и психолога и печатает пропускную
+способность и задержки p50/p95/p99 по обработчикам.
+
+Пример:
+    DATABASE_URL=postgresql://localhost/bench python bench.py --users 50 --actions 40 \\
+        --mix start=1,message=3,reply=2,check=3 --media text=6,voice=2,video_note=1
+    STORAGE_BACKEND=sqlite SQLITE_PATH=/tmp/bench.db python bench.py
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+# Лимиты отправки рассчитаны на настоящий Telegram, а антифлуд — на живых людей,
+# поэтому по умолчанию они отключаются до импорта bot (он читает настройки при загрузке)
+RATE_LIMIT_SETTINGS = ('SEND_GLOBAL_RATE', 'SEND_CHAT_RATE', 'SEND_CHAT_BURST',
+                       'SEND_GROUP_RATE', 'SEND_GROUP_BURST',
+                       'FLOOD_MESSAGE_RATE', 'FLOOD_MESSAGE_BURST',
+                       'FLOOD_CALLBACK_RATE', 'FLOOD_CALLBACK_BURST')
+
+BENCH_TOKEN = "123456:bench"
+PSYCHOLOGIST_ID = 999
+
+
+def parse_weights(value):
+    """Разбирает строку вида "start=1,message=3" в словарь весов"""
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class FakeBotApi:
+    """Заглушка Bot API: отвечает на вызовы бота правдоподобными результатами"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.group_messages = collections.deque()
+        # id сообщений в чате не повторяются и между запусками на одной базе
+        self._message_ids = itertools.count(time.time_ns() // 1000)
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'deleteMessage', 'deleteMessages'):
+            return True
+
+        chat_id = int(params.get('chat_id', 0))
+        if method == 'sendMediaGroup':
+            return [self._sent_message(chat_id, next(self._message_ids), method, {})
+                    for _ in json.loads(params['media'])]
+        message_id = int(params['message_id']) if method == 'editMessageText' else next(self._message_ids)
+        return self._sent_message(chat_id, message_id, method, params)
+
+    def _sent_message(self, chat_id, message_id, method, params):
+        if chat_id == bot.PSYCHOLOGIST_GROUP_ID and method != 'editMessageText':
+            # Пересланные психологам сообщения — на них потом "отвечает" психолог
+            self.group_messages.append(message_id)
+        chat_type = "supergroup" if chat_id < 0 else "private"
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "text": params.get('text', ''),
+        }
+
+
+def make_fake_api_app(api):
+    import tornado.web
+
+    class FakeBotApiHandler(tornado.web.RequestHandler):
+        async def post(self, token, method):
+            params = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+            if api.latency:
+                await asyncio.sleep(api.latency)
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps({"ok": True, "result": api.handle(method, params)}))
+
+    return tornado.web.Application([(r"/bot([^/]+)/(\w+)", FakeBotApiHandler)])
+
+
+class Benchmark:
+    def __init__(self, application, api, args):
+        self.application = application
+        self.api = api
+        self.args = args
+        self.mix = parse_weights(args.mix)
+        self.media = parse_weights(args.media)
+        self.latencies = collections.defaultdict(list)
+        self.errors = 0
+        self.skipped = 0
+        self.lost_albums = 0
+        self.updates = 0
+        self._update_ids = itertools.count(1)
+        # (user_id, user_message_id) уникальны в базе, поэтому id не повторяются между запусками
+        self._message_ids = itertools.count(time.time_ns() // 1000)
+        # Альбомы, пересылку которых ждет action_message: (user_id, media_group_id) -> Future
+        self._albums = {}
+
+    def instrument_albums(self):
+        """Сообщает action_message о завершении фоновой пересылки альбома"""
+        forward_media_group = bot.forward_media_group
+
+        async def forward_and_notify(bot_, user_id, media_group_id, *args):
+            try:
+                await forward_media_group(bot_, user_id, media_group_id, *args)
+            finally:
+                future = self._albums.pop((user_id, media_group_id), None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+        bot.forward_media_group = forward_and_notify
+
+    def _message(self, chat, user_id, **content):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            **content,
+        }
+
+    def private_message(self, user_id, **content):
+        chat = {"id": user_id, "type": "private"}
+        return {"update_id": next(self._update_ids), "message": self._message(chat, user_id, **content)}
+
+    def group_reply(self, reply_to, **content):
+        chat = {"id": bot.PSYCHOLOGIST_GROUP_ID, "type": "supergroup"}
+        original = {"message_id": reply_to, "date": int(time.time()), "chat": chat}
+        return {
+            "update_id": next(self._update_ids),
+            "message": self._message(chat, PSYCHOLOGIST_ID, reply_to_message=original, **content),
+        }
+
+    def callback(self, user_id, data):
+        chat = {"id": user_id, "type": "private"}
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "chat_instance": str(user_id),
+                "message": {"message_id": 1, "date": int(time.time()), "chat": chat},
+                "data": data,
+            },
+        }
+
+    async def process(self, payload):
+        update = bot.Update.de_json(payload, self.application.bot)
+        self.updates += 1
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update)
+        )
+
+    async def dispatch(self, handler, payload):
+        started = time.perf_counter()
+        await self.process(payload)
+        self.latencies[handler].append(time.perf_counter() - started)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+
+    async def action_start(self, user_id, n):
+        command = {"text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}
+        await self.dispatch("start", self.private_message(user_id, **command))
+
+    async def action_message(self, user_id, n):
+        await self.dispatch("button_handler:write_problem", self.callback(user_id, "write_problem"))
+        kind = random.choices(list(self.media), weights=list(self.media.values()))[0]
+        if kind == "voice":
+            content = {"voice": {"file_id": f"voice-{user_id}-{n}", "file_unique_id": f"v{user_id}{n}", "duration": 5}}
+        elif kind == "video_note":
+            content = {"video_note": {"file_id": f"vnote-{user_id}-{n}", "file_unique_id": f"n{user_id}{n}",
+                                      "length": 240, "duration": 5}}
+        elif kind == "photo":
+            content = {"photo": [self.photo_size(user_id, n)], "caption": f"Фото {n}"}
+        elif kind == "album":
+            # Элементы альбома приходят отдельными апдейтами с общим media_group_id. Пересылка
+            # идет в фоне после MEDIA_GROUP_WINDOW, поэтому время меряется от первого элемента
+            # до сохранения альбома, а не по обработке отдельных апдейтов
+            media_group_id = f"album-{user_id}-{n}"
+            forwarded = asyncio.get_running_loop().create_future()
+            self._albums[(user_id, media_group_id)] = forwarded
+            started = time.perf_counter()
+            for i in range(3):
+                content = {"photo": [self.photo_size(user_id, f"{n}-{i}")], "media_group_id": media_group_id}
+                await self.process(self.private_message(user_id, **content))
+            try:
+                # С --rate-limits альбом может отсечь антифлуд, и пересылки не будет
+                await asyncio.wait_for(forwarded, timeout=bot.MEDIA_GROUP_WINDOW + 30)
+            except asyncio.TimeoutError:
+                self._albums.pop((user_id, media_group_id), None)
+                self.lost_albums += 1
+                return
+            self.latencies["forward_media_group"].append(time.perf_counter() - started)
+            return
+        else:
+            content = {"text": f"Сообщение {n} от пользователя {user_id}"}
+        await self.dispatch(f"handle_message:{kind}", self.private_message(user_id, **content))
+
+    @staticmethod
+    def photo_size(user_id, n):
+        return {"file_id": f"photo-{user_id}-{n}", "file_unique_id": f"p{user_id}{n}", "width": 640, "height": 480}
+
+    async def action_reply(self, user_id, n):
+        if not self.api.group_messages:
+            self.skipped += 1
+            return
+        reply_to = self.api.group_messages.popleft()
+        await self.dispatch("handle_psychologist_response", self.group_reply(reply_to, text=f"Ответ {n}"))
+
+    async def action_check(self, user_id, n):
+        await self.dispatch("button_handler:check_response", self.callback(user_id, "check_response"))
+
+    async def run_user(self, user_id):
+        actions = list(self.mix)
+        weights = list(self.mix.values())
+        for n in range(self.args.actions):
+            action = random.choices(actions, weights=weights)[0]
+            await getattr(self, f"action_{action}")(user_id, n)
+            if self.args.think:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think))
+
+    async def run(self):
+        started = time.perf_counter()
+        await asyncio.gather(*(self.run_user(100000 + i) for i in range(self.args.users)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        print(f"\nОбработано апдейтов: {self.updates} за {elapsed:.2f} с — {self.updates / elapsed:.1f} апд/с")
+        print(f"Ошибок в обработчиках: {self.errors}, пропущено ответов психолога: {self.skipped}, "
+              f"не пересланных альбомов: {self.lost_albums}\n")
+        print(f"{'обработчик':<34}{'кол-во':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+        for handler, values in sorted(self.latencies.items()):
+            row = [percentile(values, p) * 1000 for p in (50, 95, 99)] + [max(values) * 1000]
+            print(f"{handler:<34}{len(values):>8}" + "".join(f"{v:>10.1f}" for v in row))
+        print("\nВызовы Bot API: " + ", ".join(f"{m}={c}" for m, c in sorted(self.api.calls.items())))
+
+
+async def run_benchmark(args):
+    api = FakeBotApi(latency=args.api_latency / 1000)
+    server = make_fake_api_app(api).listen(args.port, address="127.0.0.1")
+
+    if not bot.db.connect():
+        sys.exit("Не удалось подключиться к базе данных")
+    application = bot.build_application(BENCH_TOKEN, base_url=f"http://127.0.0.1:{args.port}/bot")
+    benchmark = Benchmark(application, api, args)
+    benchmark.instrument_albums()
+    application.add_error_handler(benchmark.on_error)
+
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        await bot.db.wait_ready()
+        try:
+            elapsed = await benchmark.run()
+        finally:
+            await application.stop()
+    await application.post_shutdown(application)
+    server.stop()
+    benchmark.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушкой Bot API")
+    parser.add_argument("--users", type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument("--actions", type=int, default=20, help="действий на пользователя")
+    parser.add_argument("--mix", default="start=1,message=3,reply=2,check=3",
+                        help="веса действий: start, message, reply, check")
+    parser.add_argument("--media", default="text=6,voice=2,video_note=1",
+                        help="веса типов сообщений: text, voice, video_note, photo, album")
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза между действиями, с")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--port", type=int, default=8081, help="порт заглушки Bot API")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="не отключать лимиты отправки SendScheduler и антифлуд")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if os.getenv('STORAGE_BACKEND', 'postgres') == 'postgres' and not os.getenv('DATABASE_URL'):
+        sys.exit("Укажите DATABASE_URL локальной тестовой базы данных или STORAGE_BACKEND=sqlite")
+    if not args.rate_limits:
+        for name in RATE_LIMIT_SETTINGS:
+            os.environ[name] = "1000000"
+    random.seed(args.seed)
+
+    global bot
+    import bot
+    logging.getLogger("bot").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,49 @@
+import time
+
+# Отметка начала запуска для замеров холодного старта
+STARTUP_STARTED = time.perf_counter()
+
+import abc
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import functools
+import hashlib
+import hmac
+import html
+import json
 import logging
 import os
-import psycopg2
-from psycopg2.extras import DictCursor
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import random
+import threading
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+)
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
     ConversationHandler,
+    PersistenceInput,
+    TypeHandler,
 )
 from dotenv import load_dotenv
+import httpx
+import signal
 import telegram.error
-import time
 import sys
+import tornado.httpserver
+import tornado.web
 
 PORT = int(os.environ.get('PORT', 5000))
 
@@ -29,6 +57,126 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_startup_phase_started = STARTUP_STARTED
+_startup_complete = False
+
+def log_startup_phase(phase):
+    """Пишет в лог длительность этапа запуска и общее время с начала старта"""
+    global _startup_phase_started
+    now = time.perf_counter()
+    logger.info(
+        f"Запуск: {phase} за {(now - _startup_phase_started) * 1000:.0f} мс "
+        f"(всего {(now - STARTUP_STARTED) * 1000:.0f} мс)"
+    )
+    _startup_phase_started = now
+
+# Хранилище: postgres (DATABASE_URL) или sqlite — локальный файл SQLITE_PATH для одной реплики
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'bot.db')
+
+# Настройки пула соединений с БД
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+DB_STATEMENT_TIMEOUT = float(os.getenv('DB_STATEMENT_TIMEOUT', 10))
+# Повторы проверки схемы и миграций при запуске (база может быть недоступна на холодном старте)
+DB_WARM_UP_ATTEMPTS = int(os.getenv('DB_WARM_UP_ATTEMPTS', 5))
+DB_WARM_UP_BACKOFF = float(os.getenv('DB_WARM_UP_BACKOFF', 2))       # секунд, удваивается
+
+# Ограничения исходящих запросов к Bot API
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))      # запросов в секунду на бота
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))           # в секунду на личный чат
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', 20 / 60))   # в секунду на группу
+SEND_GROUP_BURST = int(os.getenv('SEND_GROUP_BURST', 5))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+SEND_RETRY_BACKOFF = float(os.getenv('SEND_RETRY_BACKOFF', 0.5))
+# Ошибки, при которых запрос гарантированно не дошел до Telegram: его можно повторить любой
+SEND_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Методы, которые после таймаута или обрыва не повторяются: запрос мог быть выполнен
+SEND_NON_IDEMPOTENT_PREFIXES = ("send", "forward", "copy")
+
+# Доставка ответов психолога через outbox
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 5))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 60))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETRY_BACKOFF = float(os.getenv('OUTBOX_RETRY_BACKOFF', 5))
+
+# Параллельная обработка апдейтов
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 16))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', 256))
+
+# Общее состояние ConversationHandler для нескольких реплик
+CONVERSATION_FLUSH_INTERVAL = float(os.getenv('CONVERSATION_FLUSH_INTERVAL', 1))
+CONVERSATION_CACHE_TTL = float(os.getenv('CONVERSATION_CACHE_TTL', 2))
+CONVERSATION_RETRY_BACKOFF = float(os.getenv('CONVERSATION_RETRY_BACKOFF', 1))   # секунд, удваивается
+CONVERSATION_RETRY_MAX_DELAY = float(os.getenv('CONVERSATION_RETRY_MAX_DELAY', 30))
+
+# Прием вебхуков: "direct" — обработка в процессе, "queue" — через таблицу update_queue
+UPDATE_INGESTION = os.getenv('UPDATE_INGESTION', 'direct')
+UPDATE_QUEUE_WORKERS = int(os.getenv('UPDATE_QUEUE_WORKERS', 16))
+UPDATE_QUEUE_POLL_INTERVAL = float(os.getenv('UPDATE_QUEUE_POLL_INTERVAL', 5))
+UPDATE_QUEUE_LEASE = int(os.getenv('UPDATE_QUEUE_LEASE', 120))
+UPDATE_QUEUE_MAX_ATTEMPTS = int(os.getenv('UPDATE_QUEUE_MAX_ATTEMPTS', 3))
+
+# Секрет вебхука (заголовок X-Telegram-Bot-Api-Secret-Token); по умолчанию выводится
+# из токена бота, чтобы все реплики проверяли один и тот же секрет
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+# Типы апдейтов, которые бот обрабатывает: только их Telegram присылает на вебхук,
+# остальные отбрасываются до обработчиков
+HANDLED_UPDATE_TYPES = (Update.MESSAGE, Update.CALLBACK_QUERY)
+
+# Кеш маршрутизации ответов психолога: message_id в группе -> user_id
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', 10000))
+
+# Кеш пользователей с непрочитанными ответами, синхронизируемый через LISTEN/NOTIFY
+PENDING_CHANNEL = "pending_responses"
+PENDING_CACHE_REFRESH_INTERVAL = float(os.getenv('PENDING_CACHE_REFRESH_INTERVAL', 300))
+PENDING_CACHE_RECONNECT_DELAY = float(os.getenv('PENDING_CACHE_RECONNECT_DELAY', 5))
+
+# Эндпоинт метрик в формате Prometheus. С METRICS_TOKEN /metrics отдается на порту вебхука
+# по заголовку «Authorization: Bearer <токен>»; METRICS_PORT — отдельный порт
+# без авторизации, по умолчанию выключен (0) и слушает только METRICS_HOST
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Трассировка: доля апдейтов, для которых пишутся спаны, и порог записи медленных в лог
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.05))
+TRACE_SLOW_THRESHOLD = float(os.getenv('TRACE_SLOW_THRESHOLD', 1.0))   # секунд
+
+# Сэмплирующий профилировщик event loop; во время работы включается командой /profile
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0') == '1'
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.01))       # секунд между снимками стека
+PROFILER_DIR = os.getenv('PROFILER_DIR', 'profiles')
+
+# Пользователи, которым доступны служебные команды /trace и /profile
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# Окно недавно обработанных update_id для отсева повторных доставок вебхука
+DEDUP_WINDOW_SIZE = int(os.getenv('DEDUP_WINDOW_SIZE', 10000))
+
+# Антифлуд: ограничение частоты сообщений и нажатий кнопок от одного пользователя
+FLOOD_MESSAGE_RATE = float(os.getenv('FLOOD_MESSAGE_RATE', 0.2))     # сообщений в секунду
+FLOOD_MESSAGE_BURST = int(os.getenv('FLOOD_MESSAGE_BURST', 3))
+FLOOD_CALLBACK_RATE = float(os.getenv('FLOOD_CALLBACK_RATE', 1))     # нажатий в секунду
+FLOOD_CALLBACK_BURST = int(os.getenv('FLOOD_CALLBACK_BURST', 5))
+FLOOD_CLEANUP_INTERVAL = float(os.getenv('FLOOD_CLEANUP_INTERVAL', 60))
+
+# Архивация: прочитанные сообщения старше ARCHIVE_AFTER_DAYS переносятся в messages_archive
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 3600))      # 0 — архивация выключена
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+
+# Очередь неотвеченных сообщений для психологов (команда /triage в группе)
+TRIAGE_PAGE_SIZE = int(os.getenv('TRIAGE_PAGE_SIZE', 10))
+TRIAGE_COUNT_REFRESH_INTERVAL = float(os.getenv('TRIAGE_COUNT_REFRESH_INTERVAL', 60))
+TRIAGE_MESSAGE_TYPES = ("text", "voice", "video_note", "photo", "video", "document", "album")
+
+# Окно сбора элементов альбома (media group): они приходят отдельными апдейтами
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', 1.0))
+
 # Константы состояний
 WAITING_FOR_MESSAGE = 1
 
@@ -65,7 +213,8 @@ TEXTS = {
     ),
     "write_problem": (
         "✍️ *Написать о проблеме*\n\n"
-        "Опишите вашу ситуацию, отправьте видео-кружок или голосовое сообщение, "
+        "Опишите вашу ситуацию, отправьте видео-кружок, голосовое сообщение, "
+        "фото или документ, "
         "и оно будет анонимно переправлено психологу.\n\n"
         "💡 *Совет:* Будьте максимально подробны в описании - это поможет "
         "психологу лучше понять вашу ситуацию.\n\n"
@@ -88,95 +237,945 @@ TEXTS = {
     "psychologist_response": "📩 *Вы получили ответ от психолога:*\n\n{}\n\n💫 Надеемся, это поможет вам!",
     "psychologist_video_response": "📹 *Психолог отправил вам видео-ответ*\n\n🎥 Посмотрите видео ниже",
     "psychologist_voice_response": "🎤 *Психолог отправил вам голосовое сообщение*\n\n🔊 Прослушайте аудио ниже",
-    "unsupported_format": "❌ Пожалуйста, отправьте только текст, видео-кружок или голосовое сообщение.",
-    "db_error": "❌ Временные технические неполадки. Пожалуйста, попробуйте позже."
+    "unsupported_format": "❌ Пожалуйста, отправьте текст, видео-кружок, голосовое сообщение, фото, видео или документ.",
+    "db_error": "❌ Временные технические неполадки. Пожалуйста, попробуйте позже.",
+    "slow_down": "⏳ Слишком много сообщений подряд. Пожалуйста, подождите немного и попробуйте снова.",
+    "response_not_routed": "⚠️ Ответ не доставлен: не удалось найти автора сообщения. Попробуйте ответить еще раз позже.",
+    "triage_header": "📋 <b>Без ответа: {}</b>",
+    "triage_empty": "🎉 Неотвеченных сообщений нет.",
+    "triage_usage": "Использование: /triage [text|voice|video_note|photo|video|document|album]",
+    "trace_status": "🧭 Трассируется {:.0%} апдейтов, медленные — дольше {:.0f} мс",
+    "trace_usage": "Использование: /trace [доля от 0 до 1]",
+    "profile_started": "🔬 Профилировщик запущен",
+    "profile_stopped": "🔬 Профиль записан: {}",
+    "profile_status": "🔬 Профилировщик {}. Использование: /profile on|off"
 }
 
-class Database:
+# Миграции схемы: (версия, описание, SQL-выражения).
+# Применяются по порядку один раз; выражения должны быть идемпотентны,
+# чтобы накатываться и на базы, созданные до появления миграций.
+MIGRATIONS = [
+    (1, "Таблицы users и messages", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_answer TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            message_id TEXT NOT NULL,
+            user_id BIGINT REFERENCES users(user_id),
+            user_message_id TEXT,
+            message_type TEXT NOT NULL,
+            text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            answered BOOLEAN DEFAULT FALSE,
+            response TEXT,
+            response_type TEXT
+        )
+        """,
+    ]),
+    (2, "Индекс messages.message_id для save_response", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)",
+    ]),
+    (3, "Частичный индекс неотвеченных сообщений для get_pending_responses", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_pending
+        ON messages (user_id, created_at) WHERE answered = FALSE
+        """,
+    ]),
+    (4, "Outbox для доставки ответов психолога", [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            message_id TEXT NOT NULL,
+            response TEXT,
+            response_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TIMESTAMP,
+            last_error TEXT
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (next_attempt_at) WHERE delivered_at IS NULL
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_message_id ON outbox (message_id)",
+    ]),
+    (5, "Состояния ConversationHandler", [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        )
+        """,
+    ]),
+    (6, "Очередь входящих апдейтов", [
+        """
+        CREATE TABLE IF NOT EXISTS update_queue (
+            update_id BIGINT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            locked_until TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (7, "Уникальность сообщения пользователя (user_id, user_message_id)", [
+        # Дубликаты от повторных доставок вебхука. Психолог мог ответить на любую из копий,
+        # поэтому остается копия с ответом (из нескольких таких — более поздняя), иначе первая
+        """
+        DELETE FROM messages
+        WHERE id IN (
+            SELECT id
+            FROM (
+                SELECT id, row_number() OVER (
+                    PARTITION BY user_id, user_message_id
+                    ORDER BY (response IS NULL AND response_type IS NULL),
+                             CASE WHEN response IS NULL AND response_type IS NULL THEN id END,
+                             id DESC
+                ) AS position
+                FROM messages
+                WHERE user_message_id IS NOT NULL
+            ) ranked
+            WHERE position > 1
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_user_message
+        ON messages (user_id, user_message_id)
+        """,
+    ]),
+    (8, "Архив прочитанных сообщений и сводка ответов вместо users.last_answer", [
+        """
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            id INTEGER PRIMARY KEY,
+            message_id TEXT NOT NULL,
+            user_id BIGINT,
+            user_message_id TEXT,
+            message_type TEXT NOT NULL,
+            text TEXT,
+            created_at TIMESTAMP,
+            answered BOOLEAN,
+            response TEXT,
+            response_type TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS answers_count INTEGER NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS last_answered_at TIMESTAMP
+        """,
+        """
+        UPDATE users SET answers_count = answered.count
+        FROM (
+            SELECT user_id, COUNT(*) AS count FROM messages
+            WHERE response IS NOT NULL OR response_type IS NOT NULL
+            GROUP BY user_id
+        ) answered
+        WHERE users.user_id = answered.user_id
+        """,
+        "ALTER TABLE users DROP COLUMN IF EXISTS last_answer",
+    ]),
+    (9, "Индексы очереди неотвеченных сообщений для /triage", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_open
+        ON messages (created_at, id) WHERE response IS NULL AND response_type IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_open_type
+        ON messages (message_type, created_at, id) WHERE response IS NULL AND response_type IS NULL
+        """,
+    ]),
+    (10, "Альбомы: id остальных пересланных элементов альбома", [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS album_message_ids TEXT[]",
+        "ALTER TABLE messages_archive ADD COLUMN IF NOT EXISTS album_message_ids TEXT[]",
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_album
+        ON messages USING GIN (album_message_ids) WHERE album_message_ids IS NOT NULL
+        """,
+    ]),
+    (11, "Время прочтения ответа для архивации и поиск ответов в архиве", [
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS answered_at TIMESTAMP",
+        "ALTER TABLE messages_archive ADD COLUMN IF NOT EXISTS answered_at TIMESTAMP",
+        # Когда прочитаны уже отвеченные сообщения, неизвестно — отсчет архивации начинается заново
+        "UPDATE messages SET answered_at = CURRENT_TIMESTAMP WHERE answered = TRUE",
+        "CREATE INDEX IF NOT EXISTS idx_messages_answered_at ON messages (answered_at) WHERE answered = TRUE",
+        "CREATE INDEX IF NOT EXISTS idx_messages_archive_message_id ON messages_archive (message_id)",
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Схема для SQLiteDatabase повторяет итог MIGRATIONS; новые изменения схемы
+# добавляются в оба списка. Время хранится строкой UTC с миллисекундами.
+SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+SQLITE_MIGRATIONS = [
+    (1, "Схема хранилища SQLite", [
+        f"""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            created_at TIMESTAMP DEFAULT ({SQLITE_NOW}),
+            answers_count INTEGER NOT NULL DEFAULT 0,
+            last_answered_at TIMESTAMP
+        )
+        """,
+        # AUTOINCREMENT не дает повторно выдать id сообщений, перенесенных в архив
+        f"""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT NOT NULL,
+            user_id INTEGER REFERENCES users(user_id),
+            user_message_id TEXT,
+            message_type TEXT NOT NULL,
+            text TEXT,
+            created_at TIMESTAMP DEFAULT ({SQLITE_NOW}),
+            answered BOOLEAN DEFAULT FALSE,
+            response TEXT,
+            response_type TEXT,
+            album_message_ids TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages (message_id)",
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_pending
+        ON messages (user_id, created_at) WHERE answered = FALSE
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_user_message
+        ON messages (user_id, user_message_id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_open
+        ON messages (created_at, id) WHERE response IS NULL AND response_type IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_open_type
+        ON messages (message_type, created_at, id) WHERE response IS NULL AND response_type IS NULL
+        """,
+        # Вместо GIN-индекса по album_message_ids (JSON-массив): копия элемента альбома -> messages.id
+        """
+        CREATE TABLE IF NOT EXISTS album_items (
+            message_id TEXT PRIMARY KEY,
+            album_id INTEGER NOT NULL
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            id INTEGER PRIMARY KEY,
+            message_id TEXT NOT NULL,
+            user_id INTEGER,
+            user_message_id TEXT,
+            message_type TEXT NOT NULL,
+            text TEXT,
+            created_at TIMESTAMP,
+            answered BOOLEAN,
+            response TEXT,
+            response_type TEXT,
+            album_message_ids TEXT,
+            archived_at TIMESTAMP DEFAULT ({SQLITE_NOW})
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message_id TEXT NOT NULL,
+            response TEXT,
+            response_type TEXT,
+            created_at TIMESTAMP DEFAULT ({SQLITE_NOW}),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT ({SQLITE_NOW}),
+            delivered_at TIMESTAMP,
+            last_error TEXT
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (next_attempt_at) WHERE delivered_at IS NULL
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_message_id ON outbox (message_id)",
+        f"""
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT ({SQLITE_NOW}),
+            PRIMARY KEY (name, key)
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS update_queue (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT ({SQLITE_NOW}),
+            locked_until TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+    ]),
+    (2, "Время прочтения ответа для архивации и поиск ответов в архиве", [
+        "ALTER TABLE messages ADD COLUMN answered_at TIMESTAMP",
+        "ALTER TABLE messages_archive ADD COLUMN answered_at TIMESTAMP",
+        f"UPDATE messages SET answered_at = {SQLITE_NOW} WHERE answered = TRUE",
+        "CREATE INDEX IF NOT EXISTS idx_messages_answered_at ON messages (answered_at) WHERE answered = TRUE",
+        "CREATE INDEX IF NOT EXISTS idx_messages_archive_message_id ON messages_archive (message_id)",
+    ]),
+]
+SQLITE_SCHEMA_VERSION = SQLITE_MIGRATIONS[-1][0]
+
+# Колонки, которые переносятся между messages и messages_archive
+ARCHIVE_COLUMNS = ("id, message_id, user_id, user_message_id, message_type, text, "
+                   "created_at, answered, response, response_type, album_message_ids, answered_at")
+
+def sqlite_now(offset):
+    """Текущее время SQLite, сдвинутое на offset секунд (SQL-выражение или параметр)"""
+    return f"strftime('%Y-%m-%d %H:%M:%f', 'now', {offset} || ' seconds')"
+MIGRATIONS_LOCK_ID = 7243001
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    """Счетчик Prometheus с одной меткой"""
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = collections.defaultdict(int)
+
+    def inc(self, label_value, amount=1):
+        self._values[label_value] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus с одной меткой"""
+
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._counts = {}
+        self._sums = collections.defaultdict(float)
+
+    def observe(self, label_value, value):
+        counts = self._counts.get(label_value)
+        if counts is None:
+            counts = self._counts[label_value] = [0] * (len(self.buckets) + 1)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self._sums[label_value] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, counts in sorted(self._counts.items()):
+            label = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {counts[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {self._sums[label_value]}")
+            lines.append(f"{self.name}_count{{{label}}} {counts[-1]}")
+        return lines
+
+
+class Metrics:
+    """Метрики бота: задержки обработчиков, запросов к БД и вызовов Bot API"""
+
     def __init__(self):
-        self.conn = None
+        self.handler_duration = Histogram(
+            "bot_handler_duration_seconds", "Время работы обработчика апдейта", "handler")
+        self.handler_errors = Counter(
+            "bot_handler_errors_total", "Исключения в обработчиках апдейтов", "handler")
+        self.db_duration = Histogram(
+            "bot_db_query_duration_seconds", "Время выполнения метода Database", "method")
+        self.db_errors = Counter(
+            "bot_db_errors_total", "Ошибки методов Database", "method")
+        self.api_duration = Histogram(
+            "bot_api_request_duration_seconds", "Время вызова метода Bot API", "method")
+        self.api_errors = Counter(
+            "bot_api_errors_total", "Ошибки вызовов Bot API", "method")
+        self.duplicates = Counter(
+            "bot_duplicate_updates_total", "Отброшенные повторные апдейты", "source")
+        self.throttled = Counter(
+            "bot_throttled_total", "Апдейты, отклоненные антифлудом", "kind")
+        self.ignored = Counter(
+            "bot_ignored_requests_total", "Запросы вебхука и апдейты, отброшенные до обработчиков", "reason")
+        self._gauges = []
+
+    def gauge(self, name, help_text, getter):
+        """Регистрирует показатель, значение которого читается при каждом запросе метрик"""
+        self._gauges.append((name, help_text, getter))
+
+    def render(self):
+        lines = []
+        for metric in (self.handler_duration, self.handler_errors, self.db_duration,
+                       self.db_errors, self.api_duration, self.api_errors, self.duplicates,
+                       self.throttled, self.ignored):
+            lines.extend(metric.render())
+        for name, help_text, getter in self._gauges:
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {getter()}"])
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, token=None):
+        self.token = token
+
+    def get(self):
+        if self.token is not None:
+            received = self.request.headers.get("Authorization", "")
+            if not hmac.compare_digest(received.encode(), f"Bearer {self.token}".encode()):
+                self.set_status(401)
+                return
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+metrics = Metrics()
+
+def instrumented(name):
+    """Декоратор обработчика: пишет в метрики время работы и исключения"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await handler(update, context)
+            except Exception:
+                metrics.handler_errors.inc(name)
+                raise
+            finally:
+                finished = time.perf_counter()
+                metrics.handler_duration.observe(name, finished - started)
+                record_span(f"handler:{name}", started, finished)
+        return wrapper
+    return decorator
+
+# Трасса апдейта, который обрабатывается в текущей задаче (None — апдейт не попал в выборку)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Спаны одного апдейта: (имя, начало от старта апдейта, длительность) в секундах"""
+
+    __slots__ = ("update_id", "started", "spans", "token")
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.spans = []
+        self.token = None
+
+    def add(self, name, started, finished):
+        self.spans.append((name, started - self.started, finished - started))
+
+    def breakdown(self):
+        """Суммарное время по видам спанов: handler, db, api, api_wait, queue"""
+        totals = collections.defaultdict(float)
+        for name, _, duration in self.spans:
+            totals[name.partition(":")[0]] += duration
+        return totals
+
+    def format(self):
+        lines = [f"  +{offset * 1000:7.1f} мс {duration * 1000:8.1f} мс  {name}"
+                 for name, offset, duration in sorted(self.spans, key=lambda span: span[1])]
+        totals = ", ".join(f"{kind} {total * 1000:.1f} мс" for kind, total in sorted(self.breakdown().items()))
+        lines.append(f"  по видам: {totals}")
+        return "\n".join(lines)
+
+def record_span(name, started, finished):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, started, finished)
+
+class Tracer:
+    """Выборочная трассировка апдейтов.
+
+    Для доли sample_rate апдейтов собираются спаны обработчиков, методов хранилища
+    и вызовов Bot API; трассы дольше slow_threshold пишутся в лог с разбивкой.
+    Оба параметра можно менять во время работы (команда /trace).
+    """
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, slow_threshold=TRACE_SLOW_THRESHOLD):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    def start(self, update):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        trace = Trace(getattr(update, "update_id", None))
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def finish(self, trace):
+        if trace is None:
+            return
+        current_trace.reset(trace.token)
+        duration = time.perf_counter() - trace.started
+        if duration >= self.slow_threshold:
+            logger.warning(f"Медленный апдейт {trace.update_id}: {duration * 1000:.0f} мс\n{trace.format()}")
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Трасса апдейта {trace.update_id}: {duration * 1000:.0f} мс\n{trace.format()}")
+
+tracer = Tracer()
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик потока event loop.
+
+    Фоновый поток раз в interval секунд снимает стек потока event loop и считает
+    одинаковые стеки. При остановке результат пишется в directory в формате
+    «свернутых стеков» (stack;frames count), который понимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL, directory=PROFILER_DIR):
+        self.interval = interval
+        self.directory = directory
+        self._stacks = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Начинает снимать стеки потока, из которого вызван (потока event loop)"""
+        if self.running:
+            return
+        self._target = threading.get_ident()
+        self._stacks = collections.Counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Профилировщик запущен (снимок раз в {self.interval * 1000:.0f} мс)")
+
+    def stop(self):
+        """Останавливает профилировщик и возвращает путь к записанному профилю"""
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"Профиль записан: {path} ({sum(self._stacks.values())} снимков)")
+        return path
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+
+profiler = SamplingProfiler()
+
+class Storage(abc.ABC):
+    """Общая часть хранилищ: запуск запросов вне event loop, прогрев и метрики.
+
+    Реализации (Database для PostgreSQL, SQLiteDatabase) обязаны предоставить
+    абстрактные методы ниже: подключение, миграции, _execute(func) — выполнение
+    func(conn) в транзакции в рабочем потоке — и запросы, которыми пользуется бот.
+    pool не пуст, пока хранилище подключено.
+    """
+
+    # Поддерживает ли хранилище LISTEN/NOTIFY между репликами (см. PendingUsersCache)
+    supports_listen = False
+    # Версия схемы, которую ожидает код (последняя миграция хранилища)
+    schema_target = 0
+
+    def __init__(self, max_size, acquire_timeout=DB_POOL_TIMEOUT):
+        self.pool = None
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        # Семафор ограничивает число одновременных запросов числом соединений,
+        # чтобы получение соединения никогда не упиралось в их нехватку. Потоков
+        # столько же: в общем пуле asyncio их может быть меньше, чем соединений
+        self._semaphore = asyncio.Semaphore(max_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="db")
+        self._warm_up_task = None
+        self.in_use = 0
+        self.waiting = 0
+
+    def start_warm_up(self, on_failure=None):
+        """Запускает warm_up() в фоне; запросы к БД дождутся его завершения.
+
+        Неудачный прогрев повторяется с растущей паузой. Если все попытки
+        не удались, запросы к БД отклоняются и вызывается on_failure().
+        """
+        self._warm_up_task = asyncio.create_task(self._warm_up_with_retries())
+        self._warm_up_task.add_done_callback(functools.partial(self._on_warm_up_done, on_failure=on_failure))
+
+    async def _warm_up_with_retries(self, attempts=DB_WARM_UP_ATTEMPTS, backoff=DB_WARM_UP_BACKOFF):
+        delay = backoff
+        for attempt in range(1, attempts + 1):
+            try:
+                if await asyncio.to_thread(self.warm_up):
+                    return True
+            except Exception as e:
+                logger.error(f"Ошибка прогрева базы данных: {e}")
+            if attempt < attempts:
+                logger.warning(f"Прогрев базы данных не удался (попытка {attempt}/{attempts}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                delay *= 2
+        return False
+
+    @staticmethod
+    def _on_warm_up_done(task, on_failure=None):
+        if task.cancelled():
+            return
+        if task.exception() or not task.result():
+            logger.error("Не удалось инициализировать базу данных")
+            if on_failure:
+                on_failure()
+
+    @property
+    def warm_up_failed(self):
+        task = self._warm_up_task
+        return task is not None and task.done() and not task.cancelled() and (task.exception() is not None or not task.result())
+
+    def check_schema(self):
+        """Проверяет, что миграции применены, не изменяя схему (для утилит вроде export.py)"""
+        try:
+            current = self._execute(self._schema_version)
+        except Exception as e:
+            logger.error(f"Ошибка проверки схемы базы данных: {e}")
+            return False
+        if current < self.schema_target:
+            logger.error(
+                f"Схема базы данных устарела (версия {current}, нужна {self.schema_target}): "
+                "миграции применяет бот при запуске"
+            )
+            return False
+        return True
+
+    async def wait_ready(self):
+        """Дожидается завершения warm_up(), если он запущен"""
+        if self._warm_up_task is not None and not self._warm_up_task.done():
+            await asyncio.shield(self._warm_up_task)
+        # Со схемой, которую не удалось проверить или мигрировать, не работаем
+        if self.warm_up_failed:
+            raise RuntimeError("база данных не инициализирована")
+
+    async def _run(self, func):
+        """Выполняет запрос вне event loop, ограничивая параллелизм размером пула"""
+        # func — замыкание внутри метода хранилища, по его имени подписываем метрики
+        method = func.__qualname__.split('.')[1]
+        started = time.perf_counter()
+        try:
+            await self.wait_ready()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.acquire_timeout)
+            finally:
+                self.waiting -= 1
+            self.in_use += 1
+            context = contextvars.copy_context()
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(context.run, self._execute, func)
+            )
+            try:
+                return await asyncio.shield(future)
+            finally:
+                if future.done():
+                    self._release(future)
+                else:
+                    # Вызывающего отменили, а поток еще держит соединение — слот
+                    # освободится только после завершения запроса
+                    future.add_done_callback(self._release)
+        except Exception:
+            metrics.db_errors.inc(method)
+            raise
+        finally:
+            finished = time.perf_counter()
+            metrics.db_duration.observe(method, finished - started)
+            record_span(f"db:{method}", started, finished)
+
+    def _release(self, future):
+        self.in_use -= 1
+        self._semaphore.release()
+        if not future.cancelled():
+            # Результат запроса, от которого отказались, не нужен, но ошибку забираем,
+            # чтобы asyncio не жаловался на непрочитанное исключение
+            future.exception()
+
+    @abc.abstractmethod
+    def connect(self):
+        """Подключается к хранилищу; возвращает False при ошибке"""
+
+    @abc.abstractmethod
+    def close(self):
+        """Закрывает соединения"""
+
+    @abc.abstractmethod
+    def _execute(self, func):
+        """Выполняет func(conn) в транзакции (в рабочем потоке)"""
+
+    @abc.abstractmethod
+    def warm_up(self):
+        """Готовит хранилище к работе (миграции, соединения); возвращает False при ошибке"""
+
+    @abc.abstractmethod
+    def init_db(self):
+        """Применяет недостающие миграции схемы"""
+
+    @staticmethod
+    @abc.abstractmethod
+    def _schema_version(conn):
+        """Возвращает текущую версию схемы (0, если миграции еще не применялись)"""
+
+    @abc.abstractmethod
+    async def save_user_message(self, message_data):
+        """Сохраняет пользователя и его сообщение; None — повторная доставка"""
+
+    @abc.abstractmethod
+    async def get_pending_responses(self, user_id):
+        """Забирает непрочитанные ответы пользователя, помечая их прочитанными"""
+
+    @abc.abstractmethod
+    async def get_pending_users(self):
+        """Возвращает множество пользователей с непрочитанными ответами"""
+
+    @abc.abstractmethod
+    async def save_response(self, message_id, response_text, response_type=None, delivered=False):
+        """Сохраняет ответ психолога; возвращает (user_id, was_open)"""
+
+    @abc.abstractmethod
+    async def get_open_messages(self, limit, message_type=None, after=None, before=None):
+        """Возвращает страницу сообщений без ответа психолога"""
+
+    @abc.abstractmethod
+    async def count_open_messages(self):
+        """Возвращает число сообщений без ответа психолога"""
+
+    @abc.abstractmethod
+    async def get_recent_routes(self, limit):
+        """Возвращает пары (message_id, user_id) последних неотвеченных сообщений"""
+
+    @abc.abstractmethod
+    async def claim_outbox(self, limit, lease):
+        """Забирает пачку недоставленных ответов на lease секунд"""
+
+    @abc.abstractmethod
+    async def mark_outbox_delivered(self, outbox_ids):
+        """Помечает ответы доставленными"""
+
+    @abc.abstractmethod
+    async def mark_outbox_failed(self, outbox_id, error, retry_in=None):
+        """Сохраняет ошибку доставки"""
+
+    @abc.abstractmethod
+    async def load_conversation(self, name, key):
+        """Возвращает сохраненное состояние диалога или None"""
+
+    @abc.abstractmethod
+    async def save_conversations(self, states):
+        """Сохраняет пачку состояний диалогов; возвращает False при ошибке"""
+
+    @abc.abstractmethod
+    async def archive_messages(self, older_than_days, limit):
+        """Переносит прочитанные сообщения в архив; возвращает их число"""
+
+    @abc.abstractmethod
+    def iter_messages(self, date_from=None, date_to=None, answered=None, include_archive=True,
+                      batch_size=1000):
+        """Выгружает сообщения для export.py"""
+
+    @abc.abstractmethod
+    async def enqueue_update(self, update_id, payload):
+        """Сохраняет входящий апдейт в очередь"""
+
+    @abc.abstractmethod
+    async def claim_updates(self, limit, lease):
+        """Забирает из очереди апдейты на lease секунд"""
+
+    @abc.abstractmethod
+    async def complete_update(self, update_id):
+        """Удаляет обработанный апдейт из очереди"""
+
+class Database(Storage):
+    """Хранилище в PostgreSQL (DATABASE_URL) с пулом соединений psycopg2"""
+
+    supports_listen = True
+    schema_target = SCHEMA_VERSION
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 acquire_timeout=DB_POOL_TIMEOUT, statement_timeout=DB_STATEMENT_TIMEOUT):
+        super().__init__(max_size, acquire_timeout)
+        self.min_size = min_size
+        self.statement_timeout = statement_timeout
         
     def connect(self):
-        """Устанавливает соединение с базой данных"""
+        """Создает пул соединений с базой данных"""
         try:
             database_url = os.getenv('DATABASE_URL')
             if not database_url:
                 logger.error("DATABASE_URL не установлен")
                 return False
                 
-            self.conn = psycopg2.connect(database_url)
-            logger.info("Успешное подключение к базе данных")
+            # psycopg2 нужен только этому хранилищу: с STORAGE_BACKEND=sqlite он не импортируется
+            from psycopg2.extras import DictCursor
+            from psycopg2.pool import ThreadedConnectionPool
+
+            # Пул создается пустым, без обращения к сети: соединения открывает warm_up()
+            self.pool = ThreadedConnectionPool(
+                0,
+                self.max_size,
+                database_url,
+                connect_timeout=max(1, int(self.acquire_timeout)),
+                options=f"-c statement_timeout={int(self.statement_timeout * 1000)}",
+                cursor_factory=DictCursor,
+            )
+            # ThreadedConnectionPool закрывает возвращаемые соединения сверх minconn,
+            # поэтому разрешаем держать открытыми все max_size соединений
+            self.pool.minconn = self.max_size
+            logger.info(f"Пул соединений с базой данных создан (до {self.max_size} соединений)")
             return True
             
         except Exception as e:
             logger.error(f"Ошибка подключения к базе данных: {e}")
             return False
 
-    def init_db(self):
-        """Инициализирует таблицы в базе данных"""
+    def close(self):
+        """Закрывает все соединения пула"""
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
+
+    def _execute(self, func):
+        """Выполняет func(conn) в транзакции на соединении из пула (в рабочем потоке)"""
+        conn = self.pool.getconn()
         try:
-            with self.conn.cursor() as cur:
-                # Таблица пользователей
+            result = func(conn)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def warm_up(self):
+        """Проверяет схему и открывает min_size соединений пула"""
+        started = time.perf_counter()
+        ok = self.init_db()
+        conns = [self.pool.getconn() for _ in range(self.min_size)]
+        for conn in conns:
+            self.pool.putconn(conn)
+        logger.info(f"Запуск: прогрев БД за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return ok
+
+    def init_db(self):
+        """Применяет к базе данных недостающие миграции схемы"""
+        def _migrate(conn):
+            # На уже мигрированной базе это единственный запрос при запуске
+            current = self._schema_version(conn)
+            if current >= SCHEMA_VERSION:
+                return current, []
+
+            with conn.cursor() as cur:
+
+                # Блокировка не дает нескольким репликам мигрировать одновременно
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
                 cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_answer TEXT
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
                 """)
+                current = self._schema_version(conn)
                 
-                # Таблица сообщений
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id SERIAL PRIMARY KEY,
-                    message_id TEXT NOT NULL,
-                    user_id BIGINT REFERENCES users(user_id),
-                    user_message_id TEXT,
-                    message_type TEXT NOT NULL,
-                    text TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    answered BOOLEAN DEFAULT FALSE,
-                    response TEXT,
-                    response_type TEXT
-                )
-                """)
+                applied = []
+                for version, description, statements in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        cur.execute(statement)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    applied.append(version)
+                return current, applied
                 
-                self.conn.commit()
-                logger.info("Таблицы успешно инициализированы")
-                return True
+        try:
+            current, applied = self._execute(_migrate)
+            if applied:
+                logger.info(f"Применены миграции {applied} (версия схемы {current} -> {applied[-1]})")
+            else:
+                logger.info(f"Схема базы данных актуальна (версия {current})")
+            return True
                 
         except Exception as e:
             logger.error(f"Ошибка инициализации базы данных: {e}")
-            if self.conn:
-                self.conn.rollback()
             return False
 
-    def save_user(self, user_id):
+    @staticmethod
+    def _schema_version(conn):
+        """Возвращает текущую версию схемы (0, если миграции еще не применялись)"""
+        from psycopg2.errors import UndefinedTable
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                return cur.fetchone()[0]
+        except UndefinedTable:
+            conn.rollback()
+            return 0
+
+    async def save_user(self, user_id):
         """Сохраняет пользователя в базу данных"""
-        if not self.conn:
+        if not self.pool:
             return False
             
-        try:
-            with self.conn.cursor() as cur:
+        def _save(conn):
+            with conn.cursor() as cur:
                 cur.execute(
                     "INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING",
                     (user_id,)
                 )
-                self.conn.commit()
-                return True
+
+        try:
+            await self._run(_save)
+            return True
         except Exception as e:
             logger.error(f"Ошибка сохранения пользователя: {e}")
-            if self.conn:
-                self.conn.rollback()
             return False
 
-    def save_message(self, message_data):
+    async def save_message(self, message_data):
         """Сохраняет сообщение в базу данных"""
-        if not self.conn:
+        if not self.pool:
             return False
             
-        try:
-            with self.conn.cursor() as cur:
+        def _save(conn):
+            with conn.cursor() as cur:
                 cur.execute(
                     """
                     INSERT INTO messages 
@@ -191,124 +1190,2452 @@ class Database:
                         message_data.get('text')
                     )
                 )
-                self.conn.commit()
-                return True
+
+        try:
+            await self._run(_save)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения сообщения: {e}")
+            return False
+
+    async def save_user_message(self, message_data):
+        """Сохраняет пользователя и его сообщение одним запросом.
+
+        Возвращает None, если это сообщение пользователя уже сохранено (повторная доставка).
+        """
+        if not self.pool:
+            return False
+
+        def _save(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    WITH new_user AS (
+                        INSERT INTO users (user_id) VALUES (%(user_id)s)
+                        ON CONFLICT (user_id) DO NOTHING
+                    )
+                    INSERT INTO messages 
+                    (message_id, user_id, user_message_id, message_type, text, album_message_ids)
+                    VALUES (%(message_id)s, %(user_id)s, %(user_message_id)s, %(message_type)s, %(text)s,
+                            %(album_message_ids)s)
+                    ON CONFLICT (user_id, user_message_id) DO NOTHING
+                    RETURNING id
+                    """,
+                    {
+                        'message_id': message_data['message_id'],
+                        'user_id': message_data['user_id'],
+                        'user_message_id': message_data['user_message_id'],
+                        'message_type': message_data['message_type'],
+                        'text': message_data.get('text'),
+                        'album_message_ids': message_data.get('album_message_ids')
+                    }
+                )
+                return cur.fetchone() is not None
+
+        try:
+            return True if await self._run(_save) else None
         except Exception as e:
             logger.error(f"Ошибка сохранения сообщения: {e}")
-            if self.conn:
-                self.conn.rollback()
             return False
 
-    def get_pending_responses(self, user_id):
+    async def get_pending_responses(self, user_id):
         """Получает непрочитанные ответы для пользователя"""
-        if not self.conn:
+        if not self.pool:
             return []
             
-        try:
-            with self.conn.cursor(cursor_factory=DictCursor) as cur:
+        def _get(conn):
+            with conn.cursor() as cur:
+                # Выборка и пометка прочитанными одним запросом; SKIP LOCKED не дает
+                # двум параллельным нажатиям забрать (и доставить) один ответ дважды.
+                # Ответы, которые сейчас доставляет OutboxWorker (строка outbox взята
+                # в работу и ее next_attempt_at отложен), пропускаются. Строки outbox
+                # блокируются раньше messages — в том же порядке, что и у воркера.
                 cur.execute(
                     """
+                    WITH pending_outbox AS (
+                        SELECT id, message_id, next_attempt_at > CURRENT_TIMESTAMP AS leased
+                        FROM outbox
+                        WHERE user_id = %s AND delivered_at IS NULL
+                        FOR UPDATE
+                    ),
+                    claimed AS (
+                        UPDATE messages SET answered = TRUE, answered_at = CURRENT_TIMESTAMP
+                        WHERE id IN (
+                            SELECT id
+                            FROM messages 
+                            WHERE user_id = %s AND (response IS NOT NULL OR response_type IN ('video_note', 'voice')) AND answered = FALSE
+                              AND message_id NOT IN (SELECT message_id FROM pending_outbox WHERE leased)
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING message_id, response, response_type, created_at
+                    ),
+                    -- Забранные вручную ответы больше не нужно доставлять из outbox
+                    skipped AS (
+                        UPDATE outbox SET delivered_at = CURRENT_TIMESTAMP
+                        WHERE id IN (
+                            SELECT id FROM pending_outbox
+                            WHERE message_id IN (SELECT message_id FROM claimed)
+                        )
+                    )
                     SELECT message_id, response, response_type 
-                    FROM messages 
-                    WHERE user_id = %s AND (response IS NOT NULL OR response_type IN ('video_note', 'voice')) AND answered = FALSE
+                    FROM claimed
                     ORDER BY created_at
                     """,
-                    (user_id,)
+                    (user_id, user_id)
                 )
                 responses = cur.fetchall()
-                
-                if responses:
-                    # Помечаем ответы как прочитанные
-                    message_ids = [r['message_id'] for r in responses]
-                    cur.execute(
-                        "UPDATE messages SET answered = TRUE WHERE message_id = ANY(%s)",
-                        (message_ids,)
+                # Ответов у пользователя больше нет — сообщаем кешам всех реплик. Проверка
+                # идет в том же запросе, что и уведомление: ответы, пропущенные SKIP LOCKED
+                # или доставляемые из outbox, и уже закоммиченные новые ответы его отменяют
+                cur.execute(
+                    """
+                    SELECT pg_notify(%s, %s)
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM messages
+                        WHERE user_id = %s AND (response IS NOT NULL OR response_type IN ('video_note', 'voice')) AND answered = FALSE
                     )
-                    self.conn.commit()
-                
+                    """,
+                    (PENDING_CHANNEL, f"del:{user_id}", user_id)
+                )
                 return responses
+
+        try:
+            return await self._run(_get)
         except Exception as e:
             logger.error(f"Ошибка получения ответов: {e}")
-            if self.conn:
-                self.conn.rollback()
             return []
 
-    def save_response(self, message_id, response_text, response_type=None):
-        """Сохраняет ответ психолога"""
-        if not self.conn:
-            return None
-            
-        try:
-            with self.conn.cursor() as cur:
+    async def get_pending_users(self):
+        """Возвращает множество пользователей, у которых есть непрочитанные ответы"""
+        if not self.pool:
+            return set()
+
+        def _get(conn):
+            with conn.cursor() as cur:
                 cur.execute(
                     """
+                    SELECT DISTINCT user_id
+                    FROM messages
+                    WHERE (response IS NOT NULL OR response_type IN ('video_note', 'voice')) AND answered = FALSE
+                    """
+                )
+                return {row[0] for row in cur.fetchall()}
+
+        return await self._run(_get)
+
+    def listen(self, channel):
+        """Открывает отдельное соединение (вне пула), подписанное на канал NOTIFY"""
+        import psycopg2
+
+        conn = psycopg2.connect(os.getenv('DATABASE_URL'), connect_timeout=max(1, int(self.acquire_timeout)))
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {channel}")
+        return conn
+
+    @staticmethod
+    def _restore_archived(cur, message_id):
+        """Возвращает сообщение (по id любого элемента альбома) из messages_archive в messages"""
+        cur.execute(
+            f"""
+            WITH restored AS (
+                DELETE FROM messages_archive
+                WHERE id IN (
+                    SELECT id FROM messages_archive
+                    WHERE message_id = %(message_id)s OR album_message_ids @> ARRAY[%(message_id)s]
+                    LIMIT 1
+                    FOR UPDATE
+                )
+                RETURNING {ARCHIVE_COLUMNS}
+            )
+            INSERT INTO messages ({ARCHIVE_COLUMNS})
+            SELECT {ARCHIVE_COLUMNS} FROM restored
+            """,
+            {'message_id': message_id}
+        )
+        return cur.rowcount > 0
+
+    async def save_response(self, message_id, response_text, response_type=None, delivered=False):
+        """Сохраняет ответ психолога; delivered=True — ответ уже отправлен пользователю.
+
+        message_id может указывать на любой элемент альбома. Возвращает (user_id, was_open):
+        автора сообщения (None, если сообщение не найдено) и был ли это первый ответ на него.
+        """
+        if not self.pool:
+            return None, False
+            
+        def _answer(cur):
+            # Текст ответа хранится только в messages, у пользователя — компактная сводка
+            cur.execute(
+                """
+                WITH target AS (
+                    SELECT id, message_id, response IS NULL AND response_type IS NULL AS was_open
+                    FROM messages
+                    WHERE message_id = %(message_id)s OR album_message_ids @> ARRAY[%(message_id)s]
+                    LIMIT 1
+                    FOR UPDATE
+                ),
+                answered AS (
                     UPDATE messages 
-                    SET response = %s, answered = FALSE, response_type = %s
-                    WHERE message_id = %s 
-                    RETURNING user_id
-                    """,
-                    (response_text, response_type, message_id)
+                    SET response = %(response)s, answered = %(delivered)s, response_type = %(response_type)s,
+                        answered_at = CASE WHEN %(delivered)s THEN CURRENT_TIMESTAMP END
+                    FROM target
+                    WHERE messages.id = target.id
+                    RETURNING messages.user_id, target.message_id, target.was_open
+                ),
+                summary AS (
+                    UPDATE users
+                    SET answers_count = answers_count + 1, last_answered_at = CURRENT_TIMESTAMP
+                    WHERE user_id IN (SELECT user_id FROM answered)
                 )
-                result = cur.fetchone()
+                SELECT user_id, message_id, was_open FROM answered
+                """,
+                {
+                    'message_id': message_id,
+                    'response': response_text,
+                    'delivered': delivered,
+                    'response_type': response_type,
+                }
+            )
+            return cur.fetchone()
+
+        def _save(conn):
+            with conn.cursor() as cur:
+                result = _answer(cur)
+                if not result and self._restore_archived(cur, message_id):
+                    # Психолог продолжил переписку, уже перенесенную в архив
+                    result = _answer(cur)
                 if not result:
-                    return None
+                    return None, False
                 
-                user_id = result[0]
+                # В outbox пишется id самого сообщения, а не элемента альбома, на который ответили
+                user_id, original_message_id, was_open = result
+                # Ответ попадает в outbox в той же транзакции, доставит его OutboxWorker
                 cur.execute(
-                    "UPDATE users SET last_answer = %s WHERE user_id = %s",
-                    (response_text, user_id)
+                    """
+                    INSERT INTO outbox (user_id, message_id, response, response_type, delivered_at)
+                    VALUES (%s, %s, %s, %s, CASE WHEN %s THEN CURRENT_TIMESTAMP END)
+                    """,
+                    (user_id, original_message_id, response_text, response_type, delivered)
                 )
-                self.conn.commit()
-                return user_id
+                if not delivered:
+                    cur.execute("SELECT pg_notify(%s, %s)", (PENDING_CHANNEL, f"add:{user_id}"))
+                return user_id, was_open
+
+        try:
+            return await self._run(_save)
         except Exception as e:
             logger.error(f"Ошибка сохранения ответа: {e}")
-            if self.conn:
-                self.conn.rollback()
-            return None
+            return None, False
 
-# Глобальная переменная для базы данных
-db = Database()
+    async def get_open_messages(self, limit, message_type=None, after=None, before=None):
+        """Возвращает страницу сообщений без ответа психолога, от старых к новым.
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not db.conn:
-        if update.message:
-            await update.message.reply_text(TEXTS["db_error"])
+        Постраничная навигация по ключу (created_at, id): after — последняя строка
+        предыдущей страницы, before — первая строка следующей. Каждая страница —
+        один запрос по частичному индексу, независимо от длины очереди.
+        """
+        if not self.pool:
+            return []
+
+        conditions = ["response IS NULL", "response_type IS NULL"]
+        params = {'limit': limit}
+        if message_type is not None:
+            conditions.append("message_type = %(message_type)s")
+            params['message_type'] = message_type
+        if before is not None:
+            conditions.append("(created_at, id) < (%(created_at)s, %(id)s)")
+            params['created_at'], params['id'] = before
+            order = "created_at DESC, id DESC"
         else:
-            await update.callback_query.edit_message_text(TEXTS["db_error"])
-        return
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("О сообществе", callback_data="about_community"),
-            InlineKeyboardButton("О психологе", callback_data="about_psychologist"),
-        ],
-        [
-            InlineKeyboardButton("Ответ психолога", callback_data="check_response"),
-            InlineKeyboardButton("Написать о проблеме", callback_data="write_problem"),
-        ],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    if update.message:
-        await update.message.reply_text(TEXTS["start"], reply_markup=reply_markup)
-    else:
-        await update.callback_query.edit_message_text(TEXTS["start"], reply_markup=reply_markup)
+            if after is not None:
+                conditions.append("(created_at, id) > (%(created_at)s, %(id)s)")
+                params['created_at'], params['id'] = after
+            order = "created_at, id"
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    
-    if not db.conn:
-        await query.edit_message_text(TEXTS["db_error"])
-        return
-    
-    if query.data == "about_community":
-        keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_main")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(TEXTS["about_community"], reply_markup=reply_markup, parse_mode="Markdown")
-    
-    elif query.data == "about_psychologist":
-        keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_main")]]
+        def _get(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT id, message_id, message_type, text, created_at
+                    FROM messages
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY {order}
+                    LIMIT %(limit)s
+                    """,
+                    params
+                )
+                rows = cur.fetchall()
+                return rows[::-1] if before is not None else rows
+
+        try:
+            return await self._run(_get)
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди сообщений: {e}")
+            return []
+
+    async def count_open_messages(self):
+        """Возвращает число сообщений без ответа психолога"""
+        if not self.pool:
+            return 0
+
+        def _count(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT COUNT(*) FROM messages WHERE response IS NULL AND response_type IS NULL"
+                )
+                return cur.fetchone()[0]
+
+        return await self._run(_count)
+
+    async def get_recent_routes(self, limit):
+        """Возвращает пары (message_id, user_id) последних неотвеченных сообщений, от старых к новым.
+
+        Для альбома возвращается пара на каждый его элемент.
+        """
+        if not self.pool:
+            return []
+
+        def _get(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT route.message_id, recent.user_id FROM (
+                        SELECT message_id, user_id, album_message_ids, created_at
+                        FROM messages
+                        WHERE answered = FALSE
+                        ORDER BY created_at DESC
+                        LIMIT %s
+                    ) recent
+                    CROSS JOIN LATERAL unnest(
+                        array_prepend(recent.message_id, COALESCE(recent.album_message_ids, '{}'))
+                    ) AS route(message_id)
+                    ORDER BY recent.created_at
+                    """,
+                    (limit,)
+                )
+                return [(row[0], row[1]) for row in cur.fetchall()]
+
+        try:
+            return await self._run(_get)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки маршрутов ответов: {e}")
+            return []
+
+    async def claim_outbox(self, limit, lease):
+        """Забирает пачку недоставленных ответов, откладывая их повтор на lease секунд"""
+        if not self.pool:
+            return []
+
+        def _claim(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    WITH claimed AS (
+                        UPDATE outbox
+                        SET attempts = attempts + 1,
+                            next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                        WHERE id IN (
+                            SELECT id FROM outbox
+                            WHERE delivered_at IS NULL AND next_attempt_at <= CURRENT_TIMESTAMP
+                              AND attempts < %s
+                            ORDER BY next_attempt_at
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, user_id, message_id, response, response_type, attempts
+                    )
+                    SELECT * FROM claimed ORDER BY id
+                    """,
+                    (lease, OUTBOX_MAX_ATTEMPTS, limit)
+                )
+                return cur.fetchall()
+
+        try:
+            return await self._run(_claim)
+        except Exception as e:
+            logger.error(f"Ошибка чтения outbox: {e}")
+            return []
+
+    async def mark_outbox_delivered(self, outbox_ids):
+        """Помечает ответы доставленными (и прочитанными в messages)"""
+        if not self.pool:
+            return False
+
+        def _mark(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    WITH delivered AS (
+                        UPDATE outbox SET delivered_at = CURRENT_TIMESTAMP
+                        WHERE id = ANY(%s)
+                        RETURNING message_id
+                    )
+                    UPDATE messages SET answered = TRUE, answered_at = CURRENT_TIMESTAMP
+                    WHERE message_id IN (SELECT message_id FROM delivered)
+                    """,
+                    (list(outbox_ids),)
+                )
+
+        try:
+            await self._run(_mark)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления outbox: {e}")
+            return False
+
+    async def mark_outbox_failed(self, outbox_id, error, retry_in=None):
+        """Сохраняет ошибку доставки; без retry_in повторов больше не будет"""
+        if not self.pool:
+            return False
+
+        def _mark(conn):
+            with conn.cursor() as cur:
+                if retry_in is None:
+                    cur.execute(
+                        "UPDATE outbox SET last_error = %s, attempts = %s WHERE id = %s",
+                        (error, OUTBOX_MAX_ATTEMPTS, outbox_id)
+                    )
+                else:
+                    cur.execute(
+                        """
+                        UPDATE outbox
+                        SET last_error = %s,
+                            next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                        WHERE id = %s
+                        """,
+                        (error, retry_in, outbox_id)
+                    )
+
+        try:
+            await self._run(_mark)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления outbox: {e}")
+            return False
+
+    async def load_conversation(self, name, key):
+        """Возвращает сохраненное состояние диалога или None"""
+        if not self.pool:
+            return None
+
+        def _load(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT state FROM conversations WHERE name = %s AND key = %s",
+                    (name, json.dumps(key))
+                )
+                result = cur.fetchone()
+                return json.loads(result[0]) if result else None
+
+        try:
+            return await self._run(_load)
+        except Exception as e:
+            logger.error(f"Ошибка чтения состояния диалога: {e}")
+            return None
+
+    async def save_conversations(self, states):
+        """Сохраняет пачку состояний диалогов {(name, key): state}; None удаляет состояние"""
+        if not self.pool:
+            return False
+
+        upserts = [(name, json.dumps(key), json.dumps(state))
+                   for (name, key), state in states.items() if state is not None]
+        deletes = [(name, json.dumps(key))
+                   for (name, key), state in states.items() if state is None]
+
+        def _save(conn):
+            from psycopg2.extras import execute_values
+
+            with conn.cursor() as cur:
+                if upserts:
+                    execute_values(
+                        cur,
+                        """
+                        INSERT INTO conversations (name, key, state) VALUES %s
+                        ON CONFLICT (name, key)
+                        DO UPDATE SET state = EXCLUDED.state, updated_at = CURRENT_TIMESTAMP
+                        """,
+                        upserts
+                    )
+                if deletes:
+                    execute_values(
+                        cur,
+                        "DELETE FROM conversations WHERE (name, key) IN (VALUES %s)",
+                        deletes
+                    )
+
+        try:
+            await self._run(_save)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояний диалогов: {e}")
+            return False
+
+    async def archive_messages(self, older_than_days, limit):
+        """Переносит до limit сообщений, ответ на которые прочитан больше older_than_days назад, в messages_archive.
+
+        Заодно удаляет доставленные записи outbox того же возраста. Возвращает число
+        перенесенных сообщений.
+        """
+        if not self.pool:
+            return 0
+
+        age = older_than_days * 86400
+
+        def _archive(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    WITH moved AS (
+                        DELETE FROM messages
+                        WHERE id IN (
+                            SELECT id FROM messages
+                            WHERE answered = TRUE
+                              AND answered_at < CURRENT_TIMESTAMP - make_interval(secs => %(age)s)
+                            ORDER BY id
+                            LIMIT %(limit)s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING *
+                    )
+                    INSERT INTO messages_archive
+                    (id, message_id, user_id, user_message_id, message_type, text,
+                     created_at, answered, response, response_type, album_message_ids, answered_at)
+                    SELECT id, message_id, user_id, user_message_id, message_type, text,
+                           created_at, answered, response, response_type, album_message_ids, answered_at
+                    FROM moved
+                    """,
+                    {'age': age, 'limit': limit}
+                )
+                archived = cur.rowcount
+                cur.execute(
+                    """
+                    DELETE FROM outbox
+                    WHERE id IN (
+                        SELECT id FROM outbox
+                        WHERE delivered_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                        LIMIT %s
+                    )
+                    """,
+                    (age, limit)
+                )
+                return archived
+
+        try:
+            return await self._run(_archive)
+        except Exception as e:
+            logger.error(f"Ошибка архивации сообщений: {e}")
+            return 0
+
+    def iter_messages(self, date_from=None, date_to=None, answered=None, include_archive=True,
+                      batch_size=1000):
+        """Выгружает сообщения вместе с данными пользователя пачками по batch_size строк.
+
+        Синхронный генератор для выгрузок из скриптов: строки читаются серверным
+        курсором, поэтому память не зависит от размера таблицы. answered=True/False
+        оставляет только сообщения с ответом психолога или без него.
+        """
+        conditions = []
+        params = {}
+        if date_from is not None:
+            conditions.append("m.created_at >= %(date_from)s")
+            params['date_from'] = date_from
+        if date_to is not None:
+            conditions.append("m.created_at < %(date_to)s")
+            params['date_to'] = date_to
+        if answered is not None:
+            conditions.append(
+                "(m.response IS NOT NULL OR m.response_type IS NOT NULL) = %(answered)s"
+            )
+            params['answered'] = answered
+
+        columns = ("id, message_id, user_id, user_message_id, message_type, text, "
+                   "created_at, answered, response, response_type")
+        source = f"SELECT {columns}, FALSE AS archived FROM messages"
+        if include_archive:
+            source += f" UNION ALL SELECT {columns}, TRUE AS archived FROM messages_archive"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = self.pool.getconn()
+        try:
+            # Выгрузка может идти дольше statement_timeout, рассчитанного на запросы бота
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = 0")
+            with conn.cursor(name="export_messages") as cur:
+                cur.itersize = batch_size
+                cur.execute(
+                    f"""
+                    SELECT m.*, u.created_at AS user_created_at,
+                           u.answers_count, u.last_answered_at
+                    FROM ({source}) m
+                    LEFT JOIN users u ON u.user_id = m.user_id
+                    {where}
+                    ORDER BY m.id
+                    """,
+                    params
+                )
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            conn.rollback()
+            self.pool.putconn(conn)
+
+    async def enqueue_update(self, update_id, payload):
+        """Сохраняет входящий апдейт в очередь (повторная доставка игнорируется)"""
+        if not self.pool:
+            return False
+
+        def _enqueue(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO update_queue (update_id, payload) VALUES (%s, %s)
+                    ON CONFLICT (update_id) DO NOTHING
+                    """,
+                    (update_id, payload)
+                )
+
+        try:
+            await self._run(_enqueue)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи апдейта в очередь: {e}")
+            return False
+
+    async def claim_updates(self, limit, lease):
+        """Забирает из очереди до limit апдейтов на lease секунд"""
+        if not self.pool:
+            return []
+
+        def _claim(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    WITH claimed AS (
+                        UPDATE update_queue
+                        SET attempts = attempts + 1,
+                            locked_until = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                        WHERE update_id IN (
+                            SELECT update_id FROM update_queue
+                            WHERE locked_until IS NULL OR locked_until < CURRENT_TIMESTAMP
+                            ORDER BY update_id
+                            LIMIT %s
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING update_id, payload, attempts
+                    )
+                    SELECT * FROM claimed ORDER BY update_id
+                    """,
+                    (lease, limit)
+                )
+                return cur.fetchall()
+
+        try:
+            return await self._run(_claim)
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди апдейтов: {e}")
+            return []
+
+    async def complete_update(self, update_id):
+        """Удаляет обработанный апдейт из очереди"""
+        if not self.pool:
+            return False
+
+        def _complete(conn):
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM update_queue WHERE update_id = %s", (update_id,))
+
+        try:
+            await self._run(_complete)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка удаления апдейта из очереди: {e}")
+            return False
+
+class SQLiteDatabase(Storage):
+    """Встроенное хранилище в файле SQLite (WAL) для развертываний из одной реплики.
+
+    Запросы выполняются в рабочем потоке на единственном соединении, по одному:
+    локальные запросы занимают доли миллисекунды, а SQLite все равно допускает
+    только одного пишущего. NOTIFY заменяют уведомления внутри процесса (subscribe).
+    """
+
+    schema_target = SQLITE_SCHEMA_VERSION
+
+    def __init__(self, path=SQLITE_PATH, acquire_timeout=DB_POOL_TIMEOUT):
+        super().__init__(1, acquire_timeout)
+        self.path = path
+        self._listeners = {}
+        self._notifications = []
+
+    def connect(self):
+        """Открывает файл базы данных"""
+        try:
+            import sqlite3
+
+            # Время хранится в том же формате, что и SQLITE_NOW, чтобы строки сравнивались верно
+            sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" ", "milliseconds"))
+            sqlite3.register_converter("TIMESTAMP", lambda value: datetime.datetime.fromisoformat(value.decode()))
+            sqlite3.register_converter("BOOLEAN", lambda value: value != b"0")
+
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.acquire_timeout,
+                isolation_level=None,
+                check_same_thread=False,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            self.pool = conn
+            logger.info(f"База данных SQLite открыта: {self.path}")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка открытия базы данных SQLite: {e}")
+            return False
+
+    def close(self):
+        """Закрывает соединение"""
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
+    def _execute(self, func):
+        """Выполняет func(conn) в транзакции (в рабочем потоке), затем рассылает уведомления"""
+        conn = self.pool
+        self._notifications = []
+        conn.execute("BEGIN")
+        try:
+            result = func(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        # Транзакции идут по одной, поэтому уведомления приходят в порядке фиксации
+        for channel, payload in self._notifications:
+            for loop, callback in self._listeners.get(channel, ()):
+                loop.call_soon_threadsafe(callback, payload)
+        return result
+
+    def _notify(self, channel, payload):
+        """Аналог pg_notify: уведомление уйдет подписчикам после фиксации транзакции"""
+        self._notifications.append((channel, payload))
+
+    def subscribe(self, channel, callback):
+        """Подписывает callback(payload) на уведомления канала; вызывается в текущем event loop"""
+        self._listeners.setdefault(channel, []).append((asyncio.get_running_loop(), callback))
+
+    def warm_up(self):
+        """Проверяет схему"""
+        started = time.perf_counter()
+        ok = self.init_db()
+        logger.info(f"Запуск: прогрев БД за {(time.perf_counter() - started) * 1000:.0f} мс")
+        return ok
+
+    @staticmethod
+    def _schema_version(conn):
+        """Возвращает текущую версию схемы (0, если миграции еще не применялись)"""
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'").fetchone() is None:
+            return 0
+        return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    def init_db(self):
+        """Применяет к базе данных недостающие миграции схемы SQLite"""
+        def _migrate(conn):
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+            )
+            """)
+            current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+            applied = []
+            for version, description, statements in SQLITE_MIGRATIONS:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+                applied.append(version)
+            return current, applied
+
+        try:
+            current, applied = self._execute(_migrate)
+            if applied:
+                logger.info(f"Применены миграции SQLite {applied} (версия схемы {current} -> {applied[-1]})")
+            else:
+                logger.info(f"Схема базы данных SQLite актуальна (версия {current})")
+            return True
+
+        except Exception as e:
+            logger.error(f"Ошибка инициализации базы данных: {e}")
+            return False
+
+    async def save_user_message(self, message_data):
+        """Сохраняет пользователя и его сообщение в одной транзакции.
+
+        Возвращает None, если это сообщение пользователя уже сохранено (повторная доставка).
+        """
+        if not self.pool:
+            return False
+
+        album_message_ids = message_data.get('album_message_ids')
+
+        def _save(conn):
+            conn.execute(
+                "INSERT INTO users (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING",
+                (message_data['user_id'],)
+            )
+            rows = conn.execute(
+                """
+                INSERT INTO messages
+                (message_id, user_id, user_message_id, message_type, text, album_message_ids)
+                VALUES (:message_id, :user_id, :user_message_id, :message_type, :text, :album_message_ids)
+                ON CONFLICT (user_id, user_message_id) DO NOTHING
+                RETURNING id
+                """,
+                {
+                    'message_id': message_data['message_id'],
+                    'user_id': message_data['user_id'],
+                    'user_message_id': message_data['user_message_id'],
+                    'message_type': message_data['message_type'],
+                    'text': message_data.get('text'),
+                    'album_message_ids': json.dumps(album_message_ids) if album_message_ids else None
+                }
+            ).fetchall()
+            if rows and album_message_ids:
+                conn.executemany(
+                    "INSERT INTO album_items (message_id, album_id) VALUES (?, ?)",
+                    [(message_id, rows[0]['id']) for message_id in album_message_ids]
+                )
+            return bool(rows)
+
+        try:
+            return True if await self._run(_save) else None
+        except Exception as e:
+            logger.error(f"Ошибка сохранения сообщения: {e}")
+            return False
+
+    async def get_pending_responses(self, user_id):
+        """Получает непрочитанные ответы для пользователя"""
+        if not self.pool:
+            return []
+
+        def _get(conn):
+            rows = conn.execute(
+                f"""
+                UPDATE messages SET answered = TRUE, answered_at = {SQLITE_NOW}
+                WHERE user_id = ? AND (response IS NOT NULL OR response_type IN ('video_note', 'voice'))
+                  AND answered = FALSE
+                  -- Ответы, которые сейчас доставляет OutboxWorker, пропускаются
+                  AND message_id NOT IN (
+                      SELECT message_id FROM outbox
+                      WHERE user_id = ? AND delivered_at IS NULL AND next_attempt_at > {SQLITE_NOW}
+                  )
+                RETURNING message_id, response, response_type, created_at
+                """,
+                (user_id, user_id)
+            ).fetchall()
+            if rows:
+                # Забранные вручную ответы больше не нужно доставлять из outbox
+                conn.execute(
+                    f"""
+                    UPDATE outbox SET delivered_at = {SQLITE_NOW}
+                    WHERE message_id IN (SELECT value FROM json_each(?)) AND delivered_at IS NULL
+                    """,
+                    (json.dumps([row['message_id'] for row in rows]),)
+                )
+            remaining = conn.execute(
+                """
+                SELECT 1 FROM messages
+                WHERE user_id = ? AND (response IS NOT NULL OR response_type IN ('video_note', 'voice'))
+                  AND answered = FALSE
+                LIMIT 1
+                """,
+                (user_id,)
+            ).fetchone()
+            if remaining is None:
+                # Ответов у пользователя больше нет (доставляемые из outbox еще не прочитаны)
+                self._notify(PENDING_CHANNEL, f"del:{user_id}")
+            return sorted(rows, key=lambda row: row['created_at'])
+
+        try:
+            return await self._run(_get)
+        except Exception as e:
+            logger.error(f"Ошибка получения ответов: {e}")
+            return []
+
+    async def get_pending_users(self):
+        """Возвращает множество пользователей, у которых есть непрочитанные ответы"""
+        if not self.pool:
+            return set()
+
+        def _get(conn):
+            rows = conn.execute(
+                """
+                SELECT DISTINCT user_id
+                FROM messages
+                WHERE (response IS NOT NULL OR response_type IN ('video_note', 'voice')) AND answered = FALSE
+                """
+            ).fetchall()
+            return {row[0] for row in rows}
+
+        return await self._run(_get)
+
+    @staticmethod
+    def _restore_archived(conn, message_id):
+        """Возвращает сообщение (по id любого элемента альбома) из messages_archive в messages"""
+        row = conn.execute(
+            """
+            SELECT id, album_message_ids FROM messages_archive
+            WHERE message_id = :message_id
+               OR EXISTS (SELECT 1 FROM json_each(album_message_ids) WHERE value = :message_id)
+            LIMIT 1
+            """,
+            {'message_id': message_id}
+        ).fetchone()
+        if row is None:
+            return False
+        conn.execute(
+            f"INSERT INTO messages ({ARCHIVE_COLUMNS}) SELECT {ARCHIVE_COLUMNS} FROM messages_archive WHERE id = ?",
+            (row['id'],)
+        )
+        conn.execute("DELETE FROM messages_archive WHERE id = ?", (row['id'],))
+        if row['album_message_ids']:
+            conn.executemany(
+                "INSERT INTO album_items (message_id, album_id) VALUES (?, ?)",
+                [(album_message_id, row['id']) for album_message_id in json.loads(row['album_message_ids'])]
+            )
+        return True
+
+    async def save_response(self, message_id, response_text, response_type=None, delivered=False):
+        """Сохраняет ответ психолога; delivered=True — ответ уже отправлен пользователю.
+
+        message_id может указывать на любой элемент альбома. Возвращает (user_id, was_open):
+        автора сообщения (None, если сообщение не найдено) и был ли это первый ответ на него.
+        """
+        if not self.pool:
+            return None, False
+
+        def _find(conn):
+            return conn.execute(
+                """
+                SELECT id, message_id, user_id, response IS NULL AND response_type IS NULL AS was_open
+                FROM messages WHERE message_id = :message_id
+                UNION ALL
+                SELECT m.id, m.message_id, m.user_id, m.response IS NULL AND m.response_type IS NULL
+                FROM album_items a JOIN messages m ON m.id = a.album_id
+                WHERE a.message_id = :message_id
+                LIMIT 1
+                """,
+                {'message_id': message_id}
+            ).fetchall()
+
+        def _save(conn):
+            rows = _find(conn)
+            if not rows and self._restore_archived(conn, message_id):
+                # Психолог продолжил переписку, уже перенесенную в архив
+                rows = _find(conn)
+            if not rows:
+                return None, False
+
+            target = rows[0]
+            conn.execute(
+                f"""
+                UPDATE messages SET response = ?, answered = ?, response_type = ?,
+                    answered_at = CASE WHEN ? THEN {SQLITE_NOW} END
+                WHERE id = ?
+                """,
+                (response_text, delivered, response_type, delivered, target['id'])
+            )
+            # Текст ответа хранится только в messages, у пользователя — компактная сводка
+            conn.execute(
+                f"""
+                UPDATE users SET answers_count = answers_count + 1, last_answered_at = {SQLITE_NOW}
+                WHERE user_id = ?
+                """,
+                (target['user_id'],)
+            )
+            # Ответ попадает в outbox в той же транзакции, доставит его OutboxWorker
+            conn.execute(
+                f"""
+                INSERT INTO outbox (user_id, message_id, response, response_type, delivered_at)
+                VALUES (?, ?, ?, ?, CASE WHEN ? THEN {SQLITE_NOW} END)
+                """,
+                (target['user_id'], target['message_id'], response_text, response_type, delivered)
+            )
+            if not delivered:
+                self._notify(PENDING_CHANNEL, f"add:{target['user_id']}")
+            return target['user_id'], bool(target['was_open'])
+
+        try:
+            return await self._run(_save)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения ответа: {e}")
+            return None, False
+
+    async def get_open_messages(self, limit, message_type=None, after=None, before=None):
+        """Возвращает страницу сообщений без ответа психолога, от старых к новым.
+
+        Навигация по ключу (created_at, id), как в Database.get_open_messages.
+        """
+        if not self.pool:
+            return []
+
+        conditions = ["response IS NULL", "response_type IS NULL"]
+        params = {'limit': limit}
+        if message_type is not None:
+            conditions.append("message_type = :message_type")
+            params['message_type'] = message_type
+        if before is not None:
+            conditions.append("(created_at, id) < (:created_at, :id)")
+            params['created_at'], params['id'] = before
+            order = "created_at DESC, id DESC"
+        else:
+            if after is not None:
+                conditions.append("(created_at, id) > (:created_at, :id)")
+                params['created_at'], params['id'] = after
+            order = "created_at, id"
+
+        def _get(conn):
+            rows = conn.execute(
+                f"""
+                SELECT id, message_id, message_type, text, created_at
+                FROM messages
+                WHERE {' AND '.join(conditions)}
+                ORDER BY {order}
+                LIMIT :limit
+                """,
+                params
+            ).fetchall()
+            return rows[::-1] if before is not None else rows
+
+        try:
+            return await self._run(_get)
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди сообщений: {e}")
+            return []
+
+    async def count_open_messages(self):
+        """Возвращает число сообщений без ответа психолога"""
+        if not self.pool:
+            return 0
+
+        def _count(conn):
+            return conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE response IS NULL AND response_type IS NULL"
+            ).fetchone()[0]
+
+        return await self._run(_count)
+
+    async def get_recent_routes(self, limit):
+        """Возвращает пары (message_id, user_id) последних неотвеченных сообщений, от старых к новым.
+
+        Для альбома возвращается пара на каждый его элемент.
+        """
+        if not self.pool:
+            return []
+
+        def _get(conn):
+            rows = conn.execute(
+                """
+                SELECT message_id, user_id, album_message_ids FROM (
+                    SELECT message_id, user_id, album_message_ids, created_at
+                    FROM messages
+                    WHERE answered = FALSE
+                    ORDER BY created_at DESC
+                    LIMIT ?
+                )
+                ORDER BY created_at
+                """,
+                (limit,)
+            ).fetchall()
+            routes = []
+            for row in rows:
+                for message_id in [row['message_id'], *json.loads(row['album_message_ids'] or "[]")]:
+                    routes.append((message_id, row['user_id']))
+            return routes
+
+        try:
+            return await self._run(_get)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки маршрутов ответов: {e}")
+            return []
+
+    async def claim_outbox(self, limit, lease):
+        """Забирает пачку недоставленных ответов, откладывая их повтор на lease секунд"""
+        if not self.pool:
+            return []
+
+        def _claim(conn):
+            rows = conn.execute(
+                f"""
+                UPDATE outbox
+                SET attempts = attempts + 1, next_attempt_at = {sqlite_now(':lease')}
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE delivered_at IS NULL AND next_attempt_at <= {SQLITE_NOW}
+                      AND attempts < :max_attempts
+                    ORDER BY next_attempt_at
+                    LIMIT :limit
+                )
+                RETURNING id, user_id, message_id, response, response_type, attempts
+                """,
+                {'lease': lease, 'max_attempts': OUTBOX_MAX_ATTEMPTS, 'limit': limit}
+            ).fetchall()
+            return sorted(rows, key=lambda row: row['id'])
+
+        try:
+            return await self._run(_claim)
+        except Exception as e:
+            logger.error(f"Ошибка чтения outbox: {e}")
+            return []
+
+    async def mark_outbox_delivered(self, outbox_ids):
+        """Помечает ответы доставленными (и прочитанными в messages)"""
+        if not self.pool:
+            return False
+
+        def _mark(conn):
+            rows = conn.execute(
+                f"""
+                UPDATE outbox SET delivered_at = {SQLITE_NOW}
+                WHERE id IN (SELECT value FROM json_each(?))
+                RETURNING message_id
+                """,
+                (json.dumps(list(outbox_ids)),)
+            ).fetchall()
+            conn.execute(
+                f"UPDATE messages SET answered = TRUE, answered_at = {SQLITE_NOW} WHERE message_id IN (SELECT value FROM json_each(?))",
+                (json.dumps([row['message_id'] for row in rows]),)
+            )
+
+        try:
+            await self._run(_mark)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления outbox: {e}")
+            return False
+
+    async def mark_outbox_failed(self, outbox_id, error, retry_in=None):
+        """Сохраняет ошибку доставки; без retry_in повторов больше не будет"""
+        if not self.pool:
+            return False
+
+        def _mark(conn):
+            if retry_in is None:
+                conn.execute(
+                    "UPDATE outbox SET last_error = ?, attempts = ? WHERE id = ?",
+                    (error, OUTBOX_MAX_ATTEMPTS, outbox_id)
+                )
+            else:
+                conn.execute(
+                    f"UPDATE outbox SET last_error = ?, next_attempt_at = {sqlite_now('?')} WHERE id = ?",
+                    (error, retry_in, outbox_id)
+                )
+
+        try:
+            await self._run(_mark)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления outbox: {e}")
+            return False
+
+    async def load_conversation(self, name, key):
+        """Возвращает сохраненное состояние диалога или None"""
+        if not self.pool:
+            return None
+
+        def _load(conn):
+            result = conn.execute(
+                "SELECT state FROM conversations WHERE name = ? AND key = ?",
+                (name, json.dumps(key))
+            ).fetchone()
+            return json.loads(result[0]) if result else None
+
+        try:
+            return await self._run(_load)
+        except Exception as e:
+            logger.error(f"Ошибка чтения состояния диалога: {e}")
+            return None
+
+    async def save_conversations(self, states):
+        """Сохраняет пачку состояний диалогов {(name, key): state}; None удаляет состояние"""
+        if not self.pool:
+            return False
+
+        upserts = [(name, json.dumps(key), json.dumps(state))
+                   for (name, key), state in states.items() if state is not None]
+        deletes = [(name, json.dumps(key))
+                   for (name, key), state in states.items() if state is None]
+
+        def _save(conn):
+            if upserts:
+                conn.executemany(
+                    f"""
+                    INSERT INTO conversations (name, key, state) VALUES (?, ?, ?)
+                    ON CONFLICT (name, key)
+                    DO UPDATE SET state = excluded.state, updated_at = {SQLITE_NOW}
+                    """,
+                    upserts
+                )
+            if deletes:
+                conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?", deletes)
+
+        try:
+            await self._run(_save)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояний диалогов: {e}")
+            return False
+
+    async def archive_messages(self, older_than_days, limit):
+        """Переносит до limit сообщений, ответ на которые прочитан больше older_than_days назад, в messages_archive.
+
+        Заодно удаляет доставленные записи outbox того же возраста. Возвращает число
+        перенесенных сообщений.
+        """
+        if not self.pool:
+            return 0
+
+        offset = -older_than_days * 86400
+        columns = ARCHIVE_COLUMNS
+
+        def _archive(conn):
+            ids = [row[0] for row in conn.execute(
+                f"""
+                SELECT id FROM messages
+                WHERE answered = TRUE AND answered_at < {sqlite_now(':offset')}
+                ORDER BY id
+                LIMIT :limit
+                """,
+                {'offset': offset, 'limit': limit}
+            )]
+            if ids:
+                batch = json.dumps(ids)
+                conn.execute(
+                    f"""
+                    INSERT INTO messages_archive ({columns})
+                    SELECT {columns} FROM messages WHERE id IN (SELECT value FROM json_each(?))
+                    """,
+                    (batch,)
+                )
+                conn.execute("DELETE FROM album_items WHERE album_id IN (SELECT value FROM json_each(?))", (batch,))
+                conn.execute("DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))", (batch,))
+            conn.execute(
+                f"""
+                DELETE FROM outbox
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE delivered_at < {sqlite_now(':offset')}
+                    LIMIT :limit
+                )
+                """,
+                {'offset': offset, 'limit': limit}
+            )
+            return len(ids)
+
+        try:
+            return await self._run(_archive)
+        except Exception as e:
+            logger.error(f"Ошибка архивации сообщений: {e}")
+            return 0
+
+    def iter_messages(self, date_from=None, date_to=None, answered=None, include_archive=True,
+                      batch_size=1000):
+        """Выгружает сообщения вместе с данными пользователя пачками по batch_size строк.
+
+        Синхронный генератор для выгрузок из скриптов, как Database.iter_messages:
+        SQLite отдает строки по мере чтения, поэтому память не зависит от размера таблицы.
+        """
+        conditions = []
+        params = {}
+        if date_from is not None:
+            conditions.append("m.created_at >= :date_from")
+            params['date_from'] = datetime.datetime.combine(date_from, datetime.time())
+        if date_to is not None:
+            conditions.append("m.created_at < :date_to")
+            params['date_to'] = datetime.datetime.combine(date_to, datetime.time())
+        if answered is not None:
+            conditions.append("(m.response IS NOT NULL OR m.response_type IS NOT NULL) = :answered")
+            params['answered'] = answered
+
+        columns = ("id, message_id, user_id, user_message_id, message_type, text, "
+                   "created_at, answered, response, response_type")
+        source = f"SELECT {columns}, FALSE AS archived FROM messages"
+        if include_archive:
+            source += f" UNION ALL SELECT {columns}, TRUE AS archived FROM messages_archive"
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        cur = self.pool.execute(
+            f"""
+            SELECT m.*, u.created_at AS user_created_at,
+                   u.answers_count, u.last_answered_at
+            FROM ({source}) m
+            LEFT JOIN users u ON u.user_id = m.user_id
+            {where}
+            ORDER BY m.id
+            """,
+            params
+        )
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+    async def enqueue_update(self, update_id, payload):
+        """Сохраняет входящий апдейт в очередь (повторная доставка игнорируется)"""
+        if not self.pool:
+            return False
+
+        def _enqueue(conn):
+            conn.execute(
+                "INSERT INTO update_queue (update_id, payload) VALUES (?, ?) ON CONFLICT (update_id) DO NOTHING",
+                (update_id, payload)
+            )
+
+        try:
+            await self._run(_enqueue)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи апдейта в очередь: {e}")
+            return False
+
+    async def claim_updates(self, limit, lease):
+        """Забирает из очереди до limit апдейтов на lease секунд"""
+        if not self.pool:
+            return []
+
+        def _claim(conn):
+            rows = conn.execute(
+                f"""
+                UPDATE update_queue
+                SET attempts = attempts + 1, locked_until = {sqlite_now(':lease')}
+                WHERE update_id IN (
+                    SELECT update_id FROM update_queue
+                    WHERE locked_until IS NULL OR locked_until < {SQLITE_NOW}
+                    ORDER BY update_id
+                    LIMIT :limit
+                )
+                RETURNING update_id, payload, attempts
+                """,
+                {'lease': lease, 'limit': limit}
+            ).fetchall()
+            return sorted(rows, key=lambda row: row['update_id'])
+
+        try:
+            return await self._run(_claim)
+        except Exception as e:
+            logger.error(f"Ошибка чтения очереди апдейтов: {e}")
+            return []
+
+    async def complete_update(self, update_id):
+        """Удаляет обработанный апдейт из очереди"""
+        if not self.pool:
+            return False
+
+        def _complete(conn):
+            conn.execute("DELETE FROM update_queue WHERE update_id = ?", (update_id,))
+
+        try:
+            await self._run(_complete)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка удаления апдейта из очереди: {e}")
+            return False
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, накапливается не более capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Резервирует токен и возвращает, сколько секунд ждать до его появления"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self):
+        """Бакет полон — его можно удалить без потери состояния"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class UserRateLimiter:
+    """Токен-бакеты на пользователя для защиты от флуда.
+
+    Для каждого пользователя хранится только пара (токены, время обновления);
+    полные бакеты неактивных пользователей периодически удаляются.
+    """
+
+    def __init__(self, rate, burst, cleanup_interval=FLOOD_CLEANUP_INTERVAL):
+        self.rate = rate
+        self.burst = burst
+        self.cleanup_interval = cleanup_interval
+        self._buckets = {}
+        self._warned = set()
+        self._last_cleanup = time.monotonic()
+
+    def allow(self, user_id):
+        """Забирает токен пользователя; False — лимит исчерпан"""
+        now = time.monotonic()
+        if now - self._last_cleanup > self.cleanup_interval:
+            self._cleanup(now)
+
+        tokens, updated = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+        self._warned.discard(user_id)
+        return True
+
+    def should_warn(self, user_id):
+        """True только для первого отказа подряд — чтобы не отвечать на каждое сообщение флуда"""
+        if user_id in self._warned:
+            return False
+        self._warned.add(user_id)
+        return True
+
+    def _cleanup(self, now):
+        self._buckets = {
+            user_id: (tokens, updated)
+            for user_id, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.rate < self.burst
+        }
+        self._warned &= self._buckets.keys()
+        self._last_cleanup = now
+
+
+class SendScheduler(BaseRateLimiter):
+    """Планировщик всех исходящих запросов бота.
+
+    Подключается к Application как rate limiter, поэтому через него проходят
+    и context.bot.send_*, и reply_text/edit_message_text. Соблюдает общий
+    лимит и лимиты на чат, выдерживает паузу RetryAfter и повторяет запросы
+    при сетевых ошибках с экспоненциальной задержкой. Отправка сообщений после
+    таймаута не повторяется, если запрос мог дойти: иначе получатель увидит дубликат.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, group_rate=SEND_GROUP_RATE,
+                 group_burst=SEND_GROUP_BURST, max_retries=SEND_MAX_RETRIES,
+                 retry_backoff=SEND_RETRY_BACKOFF):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self._queued = 0
+
+    @property
+    def queue_depth(self):
+        """Число запросов, ожидающих своей очереди на отправку"""
+        return self._queued
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        # Полные бакеты неактивных чатов удаляем, чтобы словарь не рос бесконечно
+        if len(self._chat_buckets) > 1024:
+            for key, bucket in list(self._chat_buckets.items()):
+                if key != chat_id and bucket.is_idle():
+                    del self._chat_buckets[key]
+
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы и каналы, у них свой, более строгий лимит
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    async def _sleep(delay):
+        """Пауза, на время которой обработчик апдейта уступает свой слот другим пользователям"""
+        slot = current_update_slot.get()
+        if slot is None:
+            await asyncio.sleep(delay)
+            return
+        async with slot.released():
+            await asyncio.sleep(delay)
+
+    async def _wait_pause(self):
+        pause = self._paused_until - time.monotonic()
+        while pause > 0:
+            await self._sleep(pause)
+            pause = self._paused_until - time.monotonic()
+
+    async def _wait_turn(self, chat_id):
+        await self._wait_pause()
+        if chat_id is None:
+            return
+        delay = max(self._chat_bucket(chat_id).reserve(), self.global_bucket.reserve())
+        if delay > 0:
+            await self._sleep(delay)
+            # Пока запрос ждал лимита, другой мог получить RetryAfter
+            await self._wait_pause()
+
+    @staticmethod
+    def _can_retry(endpoint, error):
+        if isinstance(error.__cause__, SEND_NOT_SENT_ERRORS):
+            return True
+        return not endpoint.startswith(SEND_NON_IDEMPOTENT_PREFIXES)
+
+    @staticmethod
+    async def _call(endpoint, callback, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            metrics.api_errors.inc(endpoint)
+            raise
+        finally:
+            finished = time.perf_counter()
+            metrics.api_duration.observe(endpoint, finished - started)
+            record_span(f"api:{endpoint}", started, finished)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args or self.max_retries
+        chat_id = data.get("chat_id")
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        for attempt in range(max_retries + 1):
+            self._queued += 1
+            waiting_since = time.perf_counter()
+            try:
+                await self._wait_turn(chat_id)
+            finally:
+                self._queued -= 1
+                waited_until = time.perf_counter()
+                if waited_until - waiting_since >= 0.001:
+                    record_span(f"api_wait:{endpoint}", waiting_since, waited_until)
+
+            try:
+                return await self._call(endpoint, callback, args, kwargs)
+            except telegram.error.RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                # Флуд-контроль действует на весь бот — приостанавливаем все отправки
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+                logger.warning(f"{endpoint}: превышен лимит Telegram, пауза {e.retry_after} с")
+            except telegram.error.BadRequest:
+                raise
+            except telegram.error.NetworkError as e:
+                # TimedOut — тоже NetworkError, но таймаут не означает, что запрос не выполнен
+                if attempt == max_retries or not self._can_retry(endpoint, e):
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(f"{endpoint}: сетевая ошибка ({e}), повтор через {delay:.1f} с")
+                await self._sleep(delay)
+
+class OutboxWorker:
+    """Фоновая доставка ответов психолога из таблицы outbox"""
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 lease=OUTBOX_LEASE, retry_backoff=OUTBOX_RETRY_BACKOFF):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_backoff = retry_backoff
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        """Сообщает воркеру о новых записях, не дожидаясь очередного опроса"""
+        self._wakeup.set()
+
+    async def _run(self, bot):
+        while True:
+            self._wakeup.clear()
+            try:
+                rows = await db.claim_outbox(self.batch_size, self.lease)
+                if rows:
+                    await self._deliver_batch(bot, rows)
+            except Exception as e:
+                logger.error(f"Ошибка доставки из outbox: {e}")
+                rows = []
+
+            if len(rows) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _deliver_batch(self, bot, rows):
+        # Разные пользователи обслуживаются параллельно, ответы одному — по порядку
+        by_user = {}
+        for row in rows:
+            by_user.setdefault(row['user_id'], []).append(row)
+
+        await asyncio.gather(
+            *(self._deliver_user(bot, user_rows) for user_rows in by_user.values())
+        )
+
+    async def _deliver_user(self, bot, rows):
+        for row in rows:
+            try:
+                await send_response(bot, row['user_id'], row['response'], row['response_type'])
+                # Отмечаем сразу, а не после всей пачки: пока строка только взята в работу,
+                # get_pending_responses ее пропускает, и чем короче это окно, тем лучше
+                await db.mark_outbox_delivered([row['id']])
+            except (telegram.error.Forbidden, telegram.error.BadRequest) as e:
+                # Пользователь заблокировал бота или ответ некорректен — повтор не поможет
+                logger.error(f"Не удалось доставить ответ пользователю {row['user_id']}: {e}")
+                await db.mark_outbox_failed(row['id'], str(e))
+            except Exception as e:
+                retry_in = self.retry_backoff * 2 ** (row['attempts'] - 1)
+                logger.error(f"Не удалось доставить ответ пользователю {row['user_id']}, повтор через {retry_in:.0f} с: {e}")
+                await db.mark_outbox_failed(row['id'], str(e), retry_in)
+                break
+
+class ArchiveWorker:
+    """Периодически переносит старые прочитанные сообщения в messages_archive.
+
+    Горячая таблица messages и ее индексы остаются небольшими: в ней живут только
+    неотвеченные и недавние сообщения, поэтому время поиска не растет с историей.
+    """
+
+    def __init__(self, older_than_days=ARCHIVE_AFTER_DAYS, interval=ARCHIVE_INTERVAL,
+                 batch_size=ARCHIVE_BATCH_SIZE):
+        self.older_than_days = older_than_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            total = 0
+            # Небольшими пачками, чтобы не держать долгие блокировки и не занимать пул
+            while True:
+                archived = await db.archive_messages(self.older_than_days, self.batch_size)
+                total += archived
+                if archived < self.batch_size:
+                    break
+            if total:
+                logger.info(f"В архив перенесено сообщений: {total}")
+            await asyncio.sleep(self.interval)
+
+# Слот обработки апдейта, который занимает текущая задача (None — вне PerUserUpdateProcessor)
+current_update_slot = contextvars.ContextVar("current_update_slot", default=None)
+
+class UpdateSlot:
+    """Слот PerUserUpdateProcessor, занятый обработчиком апдейта.
+
+    На время ожидания лимитов отправки слот можно уступить (released()), чтобы
+    обработчики, упершиеся в лимит группы психологов, не задерживали /start и
+    кнопки остальных пользователей. Порядок апдейтов пользователя при этом
+    сохраняется: его блокировка остается занятой.
+    """
+
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        # Фоновые задачи копируют контекст, но уступать слот может только его владелец
+        self._owner = asyncio.current_task()
+        self.held = True
+
+    @contextlib.asynccontextmanager
+    async def released(self):
+        if not self.held or asyncio.current_task() is not self._owner:
+            yield
+            return
+        self.held = False
+        self._semaphore.release()
+        try:
+            yield
+        finally:
+            await self._semaphore.acquire()
+            self.held = True
+
+    def close(self):
+        if self.held:
+            self.held = False
+            self._semaphore.release()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка для каждого пользователя.
+
+    Апдейты одного пользователя (а значит, и одного состояния ConversationHandler)
+    выполняются строго по очереди, апдейты разных чатов — параллельно, не более
+    max_concurrent одновременно. Базовый семафор ограничивает общее число
+    принятых в обработку апдейтов, чтобы очередь одного пользователя не занимала
+    слоты, нужные остальным.
+    """
+
+    def __init__(self, max_concurrent=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING):
+        super().__init__(max(max_pending, max_concurrent))
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._locks = {}
+        self._waiting = {}
+        self.in_flight = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def _run(self, coroutine):
+        await self._slots.acquire()
+        slot = UpdateSlot(self._slots)
+        token = current_update_slot.set(slot)
+        try:
+            trace = current_trace.get()
+            if trace is not None and time.perf_counter() - trace.started >= 0.001:
+                # Ожидание своей очереди пользователя и свободного слота
+                trace.add("queue", trace.started, time.perf_counter())
+            self.in_flight += 1
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+        finally:
+            current_update_slot.reset(token)
+            slot.close()
+
+    async def do_process_update(self, update, coroutine):
+        if not is_handled_update(update):
+            # Сюда доходят только апдейты, присланные до смены allowed_updates
+            metrics.ignored.inc("update_type")
+            coroutine.close()
+            return
+
+        trace = tracer.start(update)
+        try:
+            await self._process(update, coroutine)
+        finally:
+            tracer.finish(trace)
+
+    async def _process(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                await self._run(coroutine)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+class ConversationPersistence(BasePersistence):
+    """Хранит состояния ConversationHandler в Postgres, чтобы бот работал в нескольких репликах.
+
+    Состояния кешируются в памяти обработчика. Изменения PTB передает раз в
+    update_interval, и они записываются в базу одной пачкой. Перед обработкой
+    апдейта read_through() подгружает состояние из базы, если локальная копия
+    отсутствует или старше cache_ttl (за это время ее могла изменить другая реплика).
+    Локальная копия с еще не записанными изменениями из базы не перечитывается,
+    поэтому корректность не зависит от соотношения update_interval и cache_ttl.
+
+    PTB не дает публичного API для подмены состояния диалога, поэтому read_through()
+    работает с приватным ConversationHandler._conversations (TrackingDict) —
+    при обновлении python-telegram-bot это место нужно проверить.
+    """
+
+    def __init__(self, flush_interval=CONVERSATION_FLUSH_INTERVAL, cache_ttl=CONVERSATION_CACHE_TTL,
+                 retry_backoff=CONVERSATION_RETRY_BACKOFF, retry_max_delay=CONVERSATION_RETRY_MAX_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.cache_ttl = cache_ttl
+        self.retry_backoff = retry_backoff
+        self.retry_max_delay = retry_max_delay
+        self._handlers = []
+        self._dirty = {}
+        self._loaded_at = {}
+        # Последнее состояние, совпадающее с базой (загруженное или записанное)
+        self._synced = {}
+        self._flush_task = None
+
+    def track(self, handler):
+        """Регистрирует ConversationHandler, состояния которого нужно подгружать"""
+        self._handlers.append(handler)
+
+    async def read_through(self, update):
+        chat, user = update.effective_chat, update.effective_user
+        if chat is None or user is None:
+            return
+        # Ключ по умолчанию для ConversationHandler (per_chat и per_user)
+        key = (chat.id, user.id)
+        now = time.monotonic()
+
+        for handler in self._handlers:
+            cache_key = (handler.name, key)
+            if cache_key in self._dirty or now - self._loaded_at.get(cache_key, float('-inf')) < self.cache_ttl:
+                continue
+            # Состояние изменено обработчиком, но еще не записано (PTB передает изменения
+            # раз в update_interval, запись может быть в процессе) — база его бы затерла
+            if cache_key in self._synced and handler._conversations.get(key) != self._synced[cache_key]:
+                continue
+
+            state = await db.load_conversation(handler.name, key)
+            self._loaded_at[cache_key] = now
+            self._synced[cache_key] = state
+            # Обновляем кеш обработчика без пометки на запись обратно в базу
+            if state is None:
+                handler._conversations.data.pop(key, None)
+            else:
+                handler._conversations.update_no_track({key: state})
+
+        if len(self._loaded_at) > 10000:
+            self._loaded_at = {k: t for k, t in self._loaded_at.items() if now - t < self.cache_ttl}
+            self._synced = {k: state for k, state in self._synced.items() if k in self._loaded_at}
+
+    def end_conversation(self, name, key):
+        """Завершает диалог вне его обработчиков (например, из фоновой задачи).
+
+        Удаление отслеживается TrackingDict, так что PTB запишет его в базу
+        вместе с остальными изменениями состояний.
+        """
+        for handler in self._handlers:
+            if handler.name == name and key in handler._conversations:
+                del handler._conversations[key]
+
+    async def get_conversations(self, name):
+        # Состояния подгружаются лениво через read_through()
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        self._dirty[(name, key)] = new_state
+        self._loaded_at[(name, key)] = time.monotonic()
+        # PTB вызывает этот метод для всех измененных ключей разом — пишем их одной пачкой
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_loop())
+
+    async def flush(self):
+        # При остановке не ждем повторов с паузами — делаем одну последнюю попытку
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self._write_dirty()
+
+    async def _write_loop(self):
+        """Пишет изменения, пока буфер не опустеет; неудачную запись повторяет с растущей паузой"""
+        delay = self.retry_backoff
+        while self._dirty:
+            if await self._write_dirty():
+                delay = self.retry_backoff
+                continue
+            logger.warning(f"Состояния диалогов не записаны ({len(self._dirty)}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max_delay)
+
+    async def _write_dirty(self):
+        if not self._dirty:
+            return True
+        states, self._dirty = self._dirty, {}
+        saved = False
+        try:
+            saved = await db.save_conversations(states)
+        finally:
+            if saved:
+                self._synced.update(states)
+            else:
+                # Не удалось записать (или запись прервана) — вернем в буфер, не затирая более свежие изменения
+                self._dirty = {**states, **self._dirty}
+        return saved
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+class UpdateQueueWorker:
+    """Пул обработчиков апдейтов из таблицы update_queue.
+
+    Забирает апдейты под аренду (lease) и передает их в update_processor
+    приложения, так что порядок апдейтов одного пользователя сохраняется.
+    Обработанные апдейты удаляются из очереди; если процесс упал, аренда
+    истекает и апдейт будет обработан после перезапуска.
+    """
+
+    def __init__(self, workers=UPDATE_QUEUE_WORKERS, poll_interval=UPDATE_QUEUE_POLL_INTERVAL,
+                 lease=UPDATE_QUEUE_LEASE, max_attempts=UPDATE_QUEUE_MAX_ATTEMPTS):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._active = set()
+        self._task = None
+
+    def start(self, application):
+        self._task = asyncio.create_task(self._run(application))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Незавершенные апдейты останутся в очереди и будут обработаны после аренды
+        for task in self._active:
+            task.cancel()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def _run(self, application):
+        while True:
+            free = self.workers - len(self._active)
+            if free <= 0:
+                await asyncio.wait(self._active, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            self._wakeup.clear()
+            rows = await db.claim_updates(free, self.lease)
+            for row in rows:
+                task = asyncio.create_task(self._process(application, row))
+                self._active.add(task)
+                task.add_done_callback(self._active.discard)
+
+            if len(rows) < free:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _process(self, application, row):
+        if row['attempts'] > self.max_attempts:
+            logger.error(f"Апдейт {row['update_id']} не обработан за {self.max_attempts} попыток, пропускаем")
+        else:
+            try:
+                update = Update.de_json(json.loads(row['payload']), application.bot)
+                await application.update_processor.process_update(update, application.process_update(update))
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {row['update_id']} из очереди: {e}")
+                return
+        await db.complete_update(row['update_id'])
+
+
+class WebhookHandler(tornado.web.RequestHandler, abc.ABC):
+    """Принимает вебхук Telegram: проверяет секрет и тип апдейта, остальное делает accept()"""
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, secret_token):
+        self.secret_token = secret_token
+
+    async def post(self):
+        # Секрет проверяется до разбора тела: посторонние запросы почти ничего не стоят
+        received = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(received.encode(), self.secret_token.encode()):
+            metrics.ignored.inc("secret")
+            self.set_status(403)
+            return
+
+        try:
+            payload = self.request.body.decode()
+            data = json.loads(payload)
+            update_id = int(data['update_id'])
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            return
+
+        if not any(update_type in data for update_type in HANDLED_UPDATE_TYPES):
+            metrics.ignored.inc("update_type")
+            self.set_status(200)
+            return
+
+        await self.accept(update_id, payload, data)
+
+    @abc.abstractmethod
+    async def accept(self, update_id, payload, data):
+        """Принимает проверенный апдейт и выставляет статус ответа"""
+
+class DirectWebhookHandler(WebhookHandler):
+    """Передает апдейт в update_queue приложения для обработки в этом процессе"""
+
+    def initialize(self, bot_app, secret_token):
+        # Имя application занято tornado: RequestHandler хранит в нем tornado.web.Application
+        super().initialize(secret_token)
+        self.bot_app = bot_app
+
+    async def accept(self, update_id, payload, data):
+        await self.bot_app.update_queue.put(Update.de_json(data, self.bot_app.bot))
+        self.set_status(200)
+
+class QueueWebhookHandler(WebhookHandler):
+    """Сохраняет апдейт в таблицу update_queue и сразу отвечает Telegram"""
+
+    def initialize(self, worker, secret_token):
+        super().initialize(secret_token)
+        self.worker = worker
+
+    async def accept(self, update_id, payload, data):
+        if await db.enqueue_update(update_id, payload):
+            self.worker.wake()
+            self.set_status(200)
+        else:
+            # Telegram повторит доставку позже
+            self.set_status(500)
+
+class RecentIds:
+    """Ограниченное окно последних идентификаторов для отсева дубликатов"""
+
+    def __init__(self, maxsize=DEDUP_WINDOW_SIZE):
+        self.maxsize = maxsize
+        self._ids = set()
+        self._order = collections.deque()
+
+    def add(self, item):
+        """Запоминает item; возвращает False, если он уже был в окне"""
+        if item in self._ids:
+            return False
+        self._ids.add(item)
+        self._order.append(item)
+        if len(self._order) > self.maxsize:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+class RouteCache:
+    """LRU-кеш соответствия сообщения в группе психологов пользователю-автору"""
+
+    def __init__(self, maxsize=ROUTE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._routes = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._warm_task = None
+
+    def get(self, message_id):
+        user_id = self._routes.get(message_id)
+        if user_id is None:
+            self.misses += 1
+            return None
+        self._routes.move_to_end(message_id)
+        self.hits += 1
+        return user_id
+
+    def put(self, message_id, user_id):
+        self._routes[message_id] = user_id
+        self._routes.move_to_end(message_id)
+        if len(self._routes) > self.maxsize:
+            self._routes.popitem(last=False)
+
+    def start_warm_load(self):
+        self._warm_task = asyncio.create_task(self.warm_load())
+
+    async def warm_load(self):
+        """Заполняет кеш последними неотвеченными сообщениями из базы"""
+        routes = await db.get_recent_routes(self.maxsize)
+        for message_id, user_id in routes:
+            self.put(message_id, user_id)
+        logger.info(f"Кеш маршрутов ответов загружен: {len(routes)} записей")
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self._routes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+class PendingUsersCache:
+    """Множество пользователей, у которых есть непрочитанные ответы психолога.
+
+    Позволяет ответить на «Ответ психолога» без запроса к базе, когда ответов нет.
+    Заполняется из базы при старте и раз в refresh_interval, а изменения от всех
+    реплик приходят через LISTEN/NOTIFY. Пока подписка не установлена, кеш не
+    используется и каждое нажатие идет в базу. Хранилище без LISTEN (SQLite)
+    присылает те же уведомления внутри процесса через subscribe().
+    """
+
+    def __init__(self, refresh_interval=PENDING_CACHE_REFRESH_INTERVAL,
+                 reconnect_delay=PENDING_CACHE_RECONNECT_DELAY):
+        self.refresh_interval = refresh_interval
+        self.reconnect_delay = reconnect_delay
+        self.ready = False
+        self._users = set()
+        self._added_during_load = None
+        self._conn = None
+        self._lost = None
+        self._task = None
+
+    def might_have_pending(self, user_id):
+        return not self.ready or user_id in self._users
+
+    def add(self, user_id):
+        self._users.add(user_id)
+        if self._added_during_load is not None:
+            self._added_during_load.add(user_id)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        if not db.supports_listen:
+            await self._run_local()
+            return
+
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._conn = await asyncio.to_thread(db.listen, PENDING_CHANNEL)
+                self._lost = asyncio.Event()
+                loop.add_reader(self._conn.fileno(), self._on_notify)
+                # Загружаем снимок после LISTEN, чтобы не пропустить изменения между ними
+                while not self._lost.is_set():
+                    await self._load()
+                    self.ready = True
+                    try:
+                        await asyncio.wait_for(self._lost.wait(), timeout=self.refresh_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                logger.warning("Подписка на уведомления о новых ответах потеряна, переподключаемся")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка кеша непрочитанных ответов: {e}")
+            finally:
+                self.ready = False
+                self._close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _run_local(self):
+        db.subscribe(PENDING_CHANNEL, self._apply)
+        while True:
+            try:
+                await self._load()
+                self.ready = True
+            except Exception as e:
+                logger.error(f"Ошибка кеша непрочитанных ответов: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def _load(self):
+        """Заменяет множество снимком из базы, сохраняя добавления, пришедшие во время запроса.
+
+        Снимок мог быть сделан до коммита такого ответа. Удаления за это время не
+        применяются повторно: лишний пользователь в множестве стоит только запроса к базе.
+        """
+        self._added_during_load = set()
+        try:
+            users = await db.get_pending_users()
+        finally:
+            added, self._added_during_load = self._added_during_load, None
+        self._users = users | added
+
+    def _on_notify(self):
+        try:
+            self._conn.poll()
+        except Exception:
+            self._lost.set()
+            self._close()
+            return
+
+        while self._conn.notifies:
+            self._apply(self._conn.notifies.pop(0).payload)
+
+    def _apply(self, payload):
+        action, _, user_id = payload.partition(":")
+        if action == "add":
+            self.add(int(user_id))
+        elif action == "del":
+            self._users.discard(int(user_id))
+
+    def _close(self):
+        if self._conn is None:
+            return
+        try:
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+        except Exception:
+            pass
+        self._conn.close()
+        self._conn = None
+
+class MediaGroupCollector:
+    """Собирает элементы альбома (media group), которые Telegram присылает отдельными апдейтами.
+
+    Альбом считается собранным, когда в течение window секунд не пришло новых элементов;
+    после этого он пересылается психологам одним send_media_group.
+    """
+
+    def __init__(self, window=MEDIA_GROUP_WINDOW):
+        self.window = window
+        self._groups = {}
+
+    def is_collecting(self, user_id, media_group_id):
+        return (user_id, media_group_id) in self._groups
+
+    def add(self, message):
+        """Добавляет элемент; возвращает True для первого элемента альбома"""
+        key = (message.from_user.id, message.media_group_id)
+        group = self._groups.get(key)
+        if group is None:
+            self._groups[key] = {"messages": [message], "updated": time.monotonic()}
+            return True
+        group["messages"].append(message)
+        group["updated"] = time.monotonic()
+        return False
+
+    async def collect(self, user_id, media_group_id):
+        """Дожидается конца альбома и возвращает его элементы по порядку"""
+        key = (user_id, media_group_id)
+        while True:
+            remaining = self._groups[key]["updated"] + self.window - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        messages = self._groups.pop(key)["messages"]
+        return sorted(messages, key=lambda message: message.message_id)
+
+class MediaGroupContinuation(filters.MessageFilter):
+    """Следующие элементы альбома, первый элемент которого уже принят handle_message"""
+
+    def filter(self, message):
+        return (
+            message.media_group_id is not None
+            and message.from_user is not None
+            and media_groups.is_collecting(message.from_user.id, message.media_group_id)
+        )
+
+class OpenCountCache:
+    """Число сообщений без ответа психолога для заголовка /triage.
+
+    Пересчитывается в базе не чаще раза в refresh_interval, а между пересчетами
+    меняется на месте: +1 за новое сообщение, -1 за первый ответ на сообщение.
+    Изменения, сделанные другими репликами, подтягиваются при пересчете.
+    """
+
+    def __init__(self, refresh_interval=TRIAGE_COUNT_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._count = None
+        self._loaded_at = 0.0
+
+    def adjust(self, delta):
+        if self._count is not None:
+            self._count = max(0, self._count + delta)
+
+    async def get(self):
+        if self._count is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+            try:
+                self._count = await db.count_open_messages()
+                self._loaded_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Ошибка подсчета неотвеченных сообщений: {e}")
+        return self._count
+
+# Глобальная переменная для базы данных
+db = SQLiteDatabase() if STORAGE_BACKEND == "sqlite" else Database()
+send_scheduler = SendScheduler()
+outbox_worker = OutboxWorker()
+archive_worker = ArchiveWorker()
+conversation_persistence = ConversationPersistence()
+update_queue_worker = UpdateQueueWorker()
+route_cache = RouteCache()
+pending_users = PendingUsersCache()
+open_count = OpenCountCache()
+media_groups = MediaGroupCollector()
+update_processor = PerUserUpdateProcessor()
+recent_updates = RecentIds()
+message_limiter = UserRateLimiter(FLOOD_MESSAGE_RATE, FLOOD_MESSAGE_BURST)
+callback_limiter = UserRateLimiter(FLOOD_CALLBACK_RATE, FLOOD_CALLBACK_BURST)
+metrics_server = None
+
+metrics.gauge("bot_db_pool_size", "Максимальный размер пула соединений", lambda: db.max_size)
+metrics.gauge("bot_db_pool_in_use", "Соединения пула, занятые запросами", lambda: db.in_use)
+metrics.gauge("bot_db_pool_waiting", "Запросы, ожидающие соединение из пула", lambda: db.waiting)
+metrics.gauge("bot_updates_in_flight", "Апдейты, обрабатываемые в данный момент", lambda: update_processor.in_flight)
+metrics.gauge("bot_send_queue_depth", "Запросы к Bot API, ожидающие лимита отправки", lambda: send_scheduler.queue_depth)
+metrics.gauge("bot_route_cache_hit_rate", "Доля попаданий в кеш маршрутов ответов", lambda: route_cache.hit_rate)
+
+async def send_response(bot, user_id, response, response_type):
+    """Отправляет пользователю ответ психолога.
+
+    Исключение означает, что ответ не доставлен: ошибка пояснения после уже
+    отправленного кружка или голосового только логируется, иначе повторная
+    доставка прислала бы медиа второй раз.
+    """
+    if response_type == 'video_note':
+        await bot.send_video_note(chat_id=user_id, video_note=response)
+        await send_response_note(bot, user_id, TEXTS["psychologist_video_response"])
+    elif response_type == 'voice':
+        await bot.send_voice(chat_id=user_id, voice=response)
+        await send_response_note(bot, user_id, TEXTS["psychologist_voice_response"])
+    else:
+        await bot.send_message(chat_id=user_id, text=TEXTS["psychologist_response"].format(response))
+
+async def send_response_note(bot, user_id, text):
+    try:
+        await bot.send_message(chat_id=user_id, text=text)
+    except Exception as e:
+        logger.warning(f"Ответ пользователю {user_id} доставлен без пояснения: {e}")
+
+@instrumented("start")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not db.pool:
+        if update.message:
+            await update.message.reply_text(TEXTS["db_error"])
+        else:
+            await update.callback_query.edit_message_text(TEXTS["db_error"])
+        return
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("О сообществе", callback_data="about_community"),
+            InlineKeyboardButton("О психологе", callback_data="about_psychologist"),
+        ],
+        [
+            InlineKeyboardButton("Ответ психолога", callback_data="check_response"),
+            InlineKeyboardButton("Написать о проблеме", callback_data="write_problem"),
+        ],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    if update.message:
+        await update.message.reply_text(TEXTS["start"], reply_markup=reply_markup)
+    else:
+        await update.callback_query.edit_message_text(TEXTS["start"], reply_markup=reply_markup)
+
+@instrumented("button_handler")
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    
+    if not db.pool:
+        await query.edit_message_text(TEXTS["db_error"])
+        return
+    
+    if query.data == "about_community":
+        keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_main")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(TEXTS["about_community"], reply_markup=reply_markup, parse_mode="Markdown")
+    
+    elif query.data == "about_psychologist":
+        keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(TEXTS["about_psychologist"], reply_markup=reply_markup, parse_mode="Markdown")
     
@@ -316,39 +3643,23 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton("Отмена", callback_data="back_to_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(TEXTS["write_problem"], reply_markup=reply_markup, parse_mode="Markdown")
+        # Метка этого ожидания сообщения: фоновая пересылка альбома завершает только его
+        context.user_data["conversation_session"] = object()
         return WAITING_FOR_MESSAGE
     
     elif query.data == "check_response":
         user_id = query.from_user.id
-        responses = db.get_pending_responses(user_id)
+        # В частом случае "ответов нет" обходимся без обращения к базе
+        if pending_users.might_have_pending(user_id):
+            responses = await db.get_pending_responses(user_id)
+        else:
+            responses = []
         
         if not responses:
             await query.edit_message_text(TEXTS["no_responses"])
         else:
             for response in responses:
-                if response['response_type'] == 'video_note':
-                    await context.bot.send_video_note(
-                        chat_id=user_id,
-                        video_note=response['response']
-                    )
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=TEXTS["psychologist_video_response"]
-                    )
-                elif response['response_type'] == 'voice':
-                    await context.bot.send_voice(
-                        chat_id=user_id,
-                        voice=response['response']
-                    )
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=TEXTS["psychologist_voice_response"]
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=TEXTS["psychologist_response"].format(response['response']),
-                    )
+                await send_response(context.bot, user_id, response['response'], response['response_type'])
         
         keyboard = [
             [
@@ -366,14 +3677,35 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == "back_to_main":
         await start(update, context)
 
+@instrumented("handle_message")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not db.conn:
+    if not db.pool:
         await update.message.reply_text(TEXTS["db_error"])
         return ConversationHandler.END
     
     user = update.message.from_user
+
+    if not message_limiter.allow(user.id):
+        metrics.throttled.inc("message")
+        if message_limiter.should_warn(user.id):
+            await update.message.reply_text(TEXTS["slow_down"])
+        return WAITING_FOR_MESSAGE
     
     try:
+        if update.message.media_group_id:
+            # Остальные элементы альбома примет collect_media_group_item, отправка — после сбора;
+            # альбом с неподдерживаемыми элементами отклоняется целиком в forward_media_group.
+            # Диалог завершается только после сохранения альбома, как и для одиночных сообщений
+            if media_groups.add(update.message):
+                context.application.create_task(
+                    forward_media_group(
+                        context.bot, user.id, update.message.media_group_id,
+                        context.user_data, context.user_data.get("conversation_session"),
+                    ),
+                    update=update,
+                )
+            return WAITING_FOR_MESSAGE
+
         if update.message.video_note:
             sent_message = await context.bot.send_video_note(
                 chat_id=PSYCHOLOGIST_GROUP_ID,
@@ -399,23 +3731,43 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_type = "text"
             text = update.message.text
         
+        elif update.message.photo:
+            sent_message = await context.bot.send_photo(
+                chat_id=PSYCHOLOGIST_GROUP_ID,
+                photo=update.message.photo[-1].file_id,
+                caption=anonymous_caption("Анонимное фото", update.message.caption),
+            )
+            message_type = "photo"
+            text = update.message.caption
+
+        elif update.message.video:
+            sent_message = await context.bot.send_video(
+                chat_id=PSYCHOLOGIST_GROUP_ID,
+                video=update.message.video.file_id,
+                caption=anonymous_caption("Анонимное видео", update.message.caption),
+            )
+            message_type = "video"
+            text = update.message.caption
+
+        elif update.message.document:
+            sent_message = await context.bot.send_document(
+                chat_id=PSYCHOLOGIST_GROUP_ID,
+                document=update.message.document.file_id,
+                caption=anonymous_caption("Анонимный документ", update.message.caption),
+            )
+            message_type = "document"
+            text = update.message.caption
+        
         else:
             await update.message.reply_text(TEXTS["unsupported_format"])
             return WAITING_FOR_MESSAGE
         
-        if not db.save_user(user.id):
-            await update.message.reply_text(TEXTS["db_error"])
+        saved = await save_forwarded_message(
+            context.bot, user.id, update.message.message_id, [sent_message], message_type, text
+        )
+        if saved is None:
             return ConversationHandler.END
-            
-        message_data = {
-            'message_id': str(sent_message.message_id),
-            'user_id': user.id,
-            'user_message_id': str(update.message.message_id),
-            'message_type': message_type,
-            'text': text
-        }
-        
-        if not db.save_message(message_data):
+        if not saved:
             await update.message.reply_text(TEXTS["db_error"])
             return ConversationHandler.END
         
@@ -430,8 +3782,84 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+def anonymous_caption(title, caption):
+    return f"{title}:\n\n{caption}" if caption else title
+
+async def save_forwarded_message(bot, user_id, user_message_id, sent_messages, message_type, text):
+    """Сохраняет пересланное психологам сообщение (для альбома — все его копии как одно сообщение).
+
+    Возвращает результат save_user_message; копии повторной доставки удаляются из группы.
+    """
+    message_ids = [str(sent.message_id) for sent in sent_messages]
+    message_data = {
+        'message_id': message_ids[0],
+        'user_id': user_id,
+        'user_message_id': str(user_message_id),
+        'message_type': message_type,
+        'text': text,
+        'album_message_ids': message_ids[1:] or None
+    }
+    
+    saved = await db.save_user_message(message_data)
+    if saved is None:
+        # Повторная доставка, которую обработала другая реплика: убираем лишнюю копию у психологов
+        metrics.duplicates.inc("db")
+        await bot.delete_messages(chat_id=PSYCHOLOGIST_GROUP_ID, message_ids=[sent.message_id for sent in sent_messages])
+    elif saved:
+        for message_id in message_ids:
+            route_cache.put(message_id, user_id)
+        open_count.adjust(1)
+    return saved
+
+@instrumented("collect_media_group_item")
+async def collect_media_group_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    media_groups.add(update.message)
+
+async def forward_media_group(bot, user_id, media_group_id, user_data, session):
+    """Пересылает собранный альбом психологам одним вызовом и сохраняет его одним сообщением.
+
+    session — метка ожидания сообщения, в котором пришел первый элемент альбома: если
+    пользователь за это время отменил его и начал новое, новое не завершается.
+    """
+    messages = await media_groups.collect(user_id, media_group_id)
+    text = "\n\n".join(message.caption for message in messages if message.caption) or None
+
+    try:
+        media = []
+        for i, message in enumerate(messages):
+            caption = anonymous_caption("Анонимный альбом", message.caption) if i == 0 else message.caption
+            if message.photo:
+                media.append(InputMediaPhoto(message.photo[-1].file_id, caption=caption))
+            elif message.video:
+                media.append(InputMediaVideo(message.video.file_id, caption=caption))
+            elif message.document:
+                media.append(InputMediaDocument(message.document.file_id, caption=caption))
+            else:
+                # Например, альбом из аудио: пересылать его частично нельзя
+                await bot.send_message(chat_id=user_id, text=TEXTS["unsupported_format"])
+                return
+        sent_messages = await bot.send_media_group(chat_id=PSYCHOLOGIST_GROUP_ID, media=media)
+        saved = await save_forwarded_message(
+            bot, user_id, messages[0].message_id, sent_messages, "album", text
+        )
+        # Альбом принят (или уже обработан другой репликой) — диалог завершается, как в handle_message
+        if user_data.get("conversation_session") is session:
+            conversation_persistence.end_conversation("main", (messages[0].chat_id, user_id))
+        if saved is None:
+            return
+        if not saved:
+            await bot.send_message(chat_id=user_id, text=TEXTS["db_error"])
+            return
+        keyboard = [[InlineKeyboardButton("В меню", callback_data="back_to_main")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await bot.send_message(chat_id=user_id, text=TEXTS["message_sent"], reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка при пересылке альбома: {e}")
+        await bot.send_message(chat_id=user_id, text="Произошла ошибка при отправке сообщения. Пожалуйста, попробуйте позже.")
+
+@instrumented("handle_psychologist_response")
 async def handle_psychologist_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not db.conn:
+    if not db.pool:
         return
         
     if update.message.chat.id != PSYCHOLOGIST_GROUP_ID or not update.message.reply_to_message:
@@ -439,115 +3867,378 @@ async def handle_psychologist_response(update: Update, context: ContextTypes.DEF
     
     replied_message_id = str(update.message.reply_to_message.message_id)
     
-    try:
-        if update.message.video_note:
-            user_id = db.save_response(
-                replied_message_id, 
-                update.message.video_note.file_id,
-                response_type="video_note"
-            )
-            if user_id:
-                try:
-                    await context.bot.send_video_note(
-                        chat_id=user_id,
-                        video_note=update.message.video_note.file_id
-                    )
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=TEXTS["psychologist_video_response"]
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить видео-ответ пользователю {user_id}: {e}")
-        
-        elif update.message.voice:
-            user_id = db.save_response(
-                replied_message_id, 
-                update.message.voice.file_id,
-                response_type="voice"
-            )
-            if user_id:
-                try:
-                    await context.bot.send_voice(
-                        chat_id=user_id,
-                        voice=update.message.voice.file_id
-                    )
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=TEXTS["psychologist_voice_response"]
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить голосовое сообщение пользователю {user_id}: {e}")
+    if update.message.video_note:
+        response, response_type = update.message.video_note.file_id, "video_note"
+    elif update.message.voice:
+        response, response_type = update.message.voice.file_id, "voice"
+    else:
+        response = update.message.text or update.message.caption or "Психолог отправил медиа-сообщение"
+        response_type = None
         
-        else:
-            response_text = update.message.text or update.message.caption or "Психолог отправил медиа-сообщение"
-            user_id = db.save_response(replied_message_id, response_text)
-            if user_id:
-                try:
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=TEXTS["psychologist_response"].format(response_text),
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-    
-    except Exception as e:
-        logger.error(f"Ошибка при обработке ответа психолога: {e}")
+    user_id = route_cache.get(replied_message_id)
+    # Если у пользователя есть недоставленные ответы (их повторяет outbox), новый
+    # ответ идет следом за ними через outbox, чтобы не обогнать их
+    if user_id is not None and not pending_users.might_have_pending(user_id):
+        # Автор известен из кеша: отвечаем сразу, а запись в базу идет в фоне
+        try:
+            await send_response(context.bot, user_id, response, response_type)
+            delivered = True
+        except Exception as e:
+            logger.error(f"Не удалось отправить ответ пользователю {user_id}, передаем в outbox: {e}")
+            delivered = False
+        context.application.create_task(
+            save_response_in_background(replied_message_id, response, response_type, delivered),
+            update=update,
+        )
+        return
+
+    # Ответ сохраняется вместе с записью в outbox; отправку выполняет OutboxWorker,
+    # поэтому медленный Bot API не задерживает обработку вебхука
+    user_id, was_open = await db.save_response(replied_message_id, response, response_type=response_type)
+    if was_open:
+        open_count.adjust(-1)
+    if user_id:
+        pending_users.add(user_id)
+        outbox_worker.wake()
+    elif update.message.reply_to_message.from_user and update.message.reply_to_message.from_user.id == context.bot.id:
+        # Ответ на пересланное ботом сообщение, которое не нашлось (или ошибка базы): без сообщения в группе он потерялся бы молча
+        logger.error(f"Ответ на сообщение {replied_message_id} не сохранен: автор не найден")
+        await update.message.reply_text(TEXTS["response_not_routed"])
+
+async def save_response_in_background(message_id, response, response_type, delivered):
+    user_id, was_open = await db.save_response(message_id, response, response_type=response_type, delivered=delivered)
+    if was_open:
+        open_count.adjust(-1)
+    if user_id is None:
+        logger.error(f"Ответ на сообщение {message_id} не сохранен")
+    elif not delivered:
+        pending_users.add(user_id)
+        outbox_worker.wake()
+
+TRIAGE_KEY_EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_triage_key(row):
+    """Ключ страницы (created_at, id) в компактном виде для callback_data (до 64 байт)"""
+    micros = (row['created_at'] - TRIAGE_KEY_EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{micros}:{row['id']}"
+
+def decode_triage_key(value):
+    micros, _, message_db_id = value.partition(":")
+    return TRIAGE_KEY_EPOCH + datetime.timedelta(microseconds=int(micros)), int(message_db_id)
+
+def group_message_link(message_id):
+    # Ссылки t.me/c/... работают для супергрупп: id -100XXXXXXXXXX превращается в XXXXXXXXXX
+    return f"https://t.me/c/{str(PSYCHOLOGIST_GROUP_ID).removeprefix('-100')}/{message_id}"
+
+async def render_triage_page(message_type=None, after=None, before=None):
+    """Собирает текст и кнопки страницы очереди неотвеченных сообщений"""
+    rows = await db.get_open_messages(TRIAGE_PAGE_SIZE + 1, message_type, after=after, before=before)
+    if before is not None:
+        has_prev, has_next = len(rows) > TRIAGE_PAGE_SIZE, True
+        rows = rows[-TRIAGE_PAGE_SIZE:]
+    else:
+        has_prev, has_next = after is not None, len(rows) > TRIAGE_PAGE_SIZE
+        rows = rows[:TRIAGE_PAGE_SIZE]
+    if not rows and (after is not None or before is not None):
+        # Сообщения этой страницы уже разобраны — показываем начало очереди
+        return await render_triage_page(message_type)
+
+    count = await open_count.get()
+    header = TEXTS["triage_header"].format(count if count is not None else "?")
+    if message_type:
+        header += f" · {message_type}"
+    lines = [header]
+    if not rows:
+        lines.append(TEXTS["triage_empty"])
+    for row in rows:
+        line = (f"{row['created_at']:%d.%m %H:%M} · {row['message_type']} · "
+                f"<a href=\"{group_message_link(row['message_id'])}\">открыть</a>")
+        if row['text']:
+            preview = row['text'] if len(row['text']) <= 80 else row['text'][:80] + "…"
+            line += f"\n{html.escape(preview)}"
+        lines.append(line)
+
+    type_key = message_type or "*"
+    buttons = []
+    if has_prev and rows:
+        buttons.append(InlineKeyboardButton("◀️ Раньше", callback_data=f"triage:p:{type_key}:{encode_triage_key(rows[0])}"))
+    if has_next and rows:
+        buttons.append(InlineKeyboardButton("Позже ▶️", callback_data=f"triage:n:{type_key}:{encode_triage_key(rows[-1])}"))
+    return "\n\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+@instrumented("triage")
+async def triage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message_type = context.args[0] if context.args else None
+    if message_type is not None and message_type not in TRIAGE_MESSAGE_TYPES:
+        await update.message.reply_text(TEXTS["triage_usage"])
+        return
+
+    text, reply_markup = await render_triage_page(message_type)
+    await update.message.reply_text(
+        text, reply_markup=reply_markup, parse_mode="HTML", disable_web_page_preview=True
+    )
+
+@instrumented("triage_page")
+async def triage_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    # Очередь содержит превью анонимных сообщений — листать её можно только в группе психологов
+    if query.message is None or query.message.chat.id != PSYCHOLOGIST_GROUP_ID:
+        return
+
+    try:
+        _, direction, type_key, key = query.data.split(":", 3)
+        page_key = decode_triage_key(key)
+    except ValueError:
+        logger.warning(f"Некорректные данные кнопки очереди: {query.data!r}")
+        return
+    message_type = None if type_key == "*" else type_key
+    if message_type is not None and message_type not in TRIAGE_MESSAGE_TYPES:
+        return
+    if direction == "p":
+        text, reply_markup = await render_triage_page(message_type, before=page_key)
+    else:
+        text, reply_markup = await render_triage_page(message_type, after=page_key)
+    try:
+        await query.edit_message_text(
+            text, reply_markup=reply_markup, parse_mode="HTML", disable_web_page_preview=True
+        )
+    except telegram.error.BadRequest as e:
+        # Страница не изменилась (например, очередь разобрали до нажатия)
+        if "not modified" not in str(e):
+            raise
+
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        try:
+            sample_rate = float(context.args[0])
+        except ValueError:
+            sample_rate = None
+        if sample_rate is None or not 0 <= sample_rate <= 1:
+            await update.message.reply_text(TEXTS["trace_usage"])
+            return
+        tracer.sample_rate = sample_rate
+        logger.info(f"Доля трассируемых апдейтов изменена: {sample_rate:.0%}")
+    await update.message.reply_text(
+        TEXTS["trace_status"].format(tracer.sample_rate, tracer.slow_threshold * 1000)
+    )
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = context.args[0] if context.args else None
+    if action == "on":
+        profiler.start()
+        await update.message.reply_text(TEXTS["profile_started"])
+    elif action == "off" and profiler.running:
+        path = await asyncio.to_thread(profiler.stop)
+        await update.message.reply_text(TEXTS["profile_stopped"].format(path))
+    else:
+        status = "работает" if profiler.running else "выключен"
+        await update.message.reply_text(TEXTS["profile_status"].format(status))
+
+async def drop_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Telegram повторно присылает апдейт, если вебхук ответил слишком медленно
+    if not recent_updates.add(update.update_id):
+        metrics.duplicates.inc("memory")
+        raise ApplicationHandlerStop
+
+async def throttle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not callback_limiter.allow(query.from_user.id):
+        metrics.throttled.inc("callback")
+        # Ответ на callback нужен в любом случае, так что предупреждение ничего не стоит
+        await query.answer(TEXTS["slow_down"])
+        raise ApplicationHandlerStop
+
+async def load_conversation_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _startup_complete
+    if not _startup_complete:
+        _startup_complete = True
+        log_startup_phase("получение первого апдейта")
+    await conversation_persistence.read_through(update)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await start(update, context)
     return ConversationHandler.END
 
+async def post_init(application: Application):
+    log_startup_phase("инициализация приложения")
+    # Схема и соединения готовятся в фоне, пока поднимается вебхук. Если база так и не
+    # готова, останавливаемся как по SIGTERM, чтобы платформа перезапустила процесс
+    db.start_warm_up(on_failure=lambda: os.kill(os.getpid(), signal.SIGTERM))
+    outbox_worker.start(application.bot)
+    if ARCHIVE_INTERVAL:
+        archive_worker.start()
+    route_cache.start_warm_load()
+    pending_users.start()
+    if PROFILER_ENABLED:
+        profiler.start()
+    if METRICS_PORT:
+        global metrics_server
+        metrics_server = tornado.httpserver.HTTPServer(tornado.web.Application([("/metrics", MetricsHandler)]))
+        metrics_server.listen(METRICS_PORT, address=METRICS_HOST)
+
+async def post_shutdown(application: Application):
+    if metrics_server:
+        metrics_server.stop()
+    if profiler.running:
+        profiler.stop()
+    logger.info(f"Статистика кеша маршрутов ответов: {route_cache.stats()}")
+    await outbox_worker.stop()
+    await archive_worker.stop()
+    await pending_users.stop()
+    db.close()
+
+def webhook_secret_token(token):
+    """Секрет вебхука: WEBHOOK_SECRET_TOKEN или производный от токена бота"""
+    return WEBHOOK_SECRET_TOKEN or hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+def is_handled_update(update):
+    if not isinstance(update, Update):
+        return True
+    return any(getattr(update, update_type) is not None for update_type in HANDLED_UPDATE_TYPES)
+
+async def run_webhook(application: Application, url_path, webhook_url, secret_token, ingestion=UPDATE_INGESTION):
+    """Запускает бота на собственном сервере вебхука (рядом с ним отдается /metrics).
+
+    В режиме direct апдейты сразу передаются приложению, в режиме queue —
+    сохраняются в таблицу update_queue и разбираются пулом update_queue_worker.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+
+        if ingestion == "queue":
+            webhook_route = (
+                f"/{url_path}",
+                QueueWebhookHandler,
+                {"worker": update_queue_worker, "secret_token": secret_token},
+            )
+        else:
+            webhook_route = (
+                f"/{url_path}",
+                DirectWebhookHandler,
+                {"bot_app": application, "secret_token": secret_token},
+            )
+        routes = [webhook_route]
+        if METRICS_TOKEN:
+            # На Render снаружи доступен только $PORT, поэтому метрики отдаются рядом с вебхуком
+            routes.append(("/metrics", MetricsHandler, {"token": METRICS_TOKEN}))
+        server = tornado.httpserver.HTTPServer(tornado.web.Application(routes))
+        server.listen(PORT, address="0.0.0.0")
+        log_startup_phase("запуск вебхука")
+        if ingestion == "queue":
+            update_queue_worker.start(application)
+        # Порт уже слушается, поэтому регистрация вебхука не задерживает прием апдейтов
+        await application.bot.set_webhook(
+            webhook_url, allowed_updates=list(HANDLED_UPDATE_TYPES), secret_token=secret_token
+        )
+        try:
+            await stop_event.wait()
+        finally:
+            server.stop()
+            await update_queue_worker.stop()
+            await application.stop()
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+def build_application(token, base_url=None):
+    """Собирает Application со всеми обработчиками бота"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(send_scheduler)
+        .concurrent_updates(update_processor)
+        .persistence(conversation_persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start), CallbackQueryHandler(button_handler)],
+        states={
+            WAITING_FOR_MESSAGE: [
+                MessageHandler(
+                    filters.TEXT | filters.VIDEO_NOTE | filters.VOICE | filters.PHOTO | filters.VIDEO
+                    | filters.Document.ALL | filters.AUDIO,
+                    handle_message
+                )
+            ],
+        },
+        fallbacks=[CallbackQueryHandler(cancel, pattern="back_to_main")],
+        name="main",
+        persistent=True,
+    )
+    conversation_persistence.track(conv_handler)
+    
+    # Повторные доставки отбрасываются до любой обработки
+    application.add_handler(TypeHandler(Update, drop_duplicate_update), group=-3)
+    # Слишком частые нажатия кнопок отсекаются до обработчиков меню
+    application.add_handler(CallbackQueryHandler(throttle_callback), group=-2)
+    # Состояние диалога подгружается из общей базы до того, как его проверит conv_handler
+    application.add_handler(TypeHandler(Update, load_conversation_state), group=-1)
+    # Служебные команды трассировки и профилирования доступны только ADMIN_IDS
+    application.add_handler(CommandHandler("trace", trace_command, filters=filters.User(ADMIN_IDS)))
+    application.add_handler(CommandHandler("profile", profile_command, filters=filters.User(ADMIN_IDS)))
+    # Команды психологов регистрируются раньше conv_handler, чей CallbackQueryHandler принимает любые кнопки
+    application.add_handler(CommandHandler("triage", triage, filters=filters.Chat(PSYCHOLOGIST_GROUP_ID)))
+    application.add_handler(CallbackQueryHandler(triage_page, pattern=r"^triage:"))
+    # Элементы альбома после первого принимаются в обход состояния диалога
+    application.add_handler(
+        MessageHandler(filters.ChatType.PRIVATE & MediaGroupContinuation(), collect_media_group_item)
+    )
+    application.add_handler(conv_handler)
+    application.add_handler(
+        MessageHandler(
+            (filters.TEXT | filters.VIDEO_NOTE | filters.VOICE) & ~filters.COMMAND & filters.Chat(PSYCHOLOGIST_GROUP_ID),
+            handle_psychologist_response
+        )
+    )
+    return application
+
 def main():
     # Проверяем обязательные переменные
     if not os.getenv('TELEGRAM_BOT_TOKEN'):
         logger.error("Не указан токен бота!")
         return
     
-    if not os.getenv('DATABASE_URL'):
+    if STORAGE_BACKEND == "postgres" and not os.getenv('DATABASE_URL'):
         logger.error("Не указана строка подключения к БД!")
         return
     
-    # Инициализация базы данных
+    log_startup_phase("импорт модулей")
+
+    # Инициализация базы данных (схема проверяется в фоне, см. post_init)
     if not db.connect():
         logger.error("Не удалось подключиться к базе данных")
         return
-        
-    if not db.init_db():
-        logger.error("Не удалось инициализировать базу данных")
-        return
     
     try:
-        application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-        
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start), CallbackQueryHandler(button_handler)],
-            states={
-                WAITING_FOR_MESSAGE: [
-                    MessageHandler(filters.TEXT | filters.VIDEO_NOTE | filters.VOICE, handle_message)
-                ],
-            },
-            fallbacks=[CallbackQueryHandler(cancel, pattern="back_to_main")],
-        )
-        
-        application.add_handler(conv_handler)
-        application.add_handler(
-            MessageHandler(
-                (filters.TEXT | filters.VIDEO_NOTE | filters.VOICE) & ~filters.COMMAND & filters.Chat(PSYCHOLOGIST_GROUP_ID),
-                handle_psychologist_response
-            )
-        )
+        application = build_application(os.getenv('TELEGRAM_BOT_TOKEN'))
         
+        log_startup_phase("сборка приложения")
+
         # Запуск для Render
         logger.info("Бот запускается на Render...")
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=os.getenv('TELEGRAM_BOT_TOKEN'),
-            webhook_url=f"https://{os.getenv('RENDER_SERVICE_NAME')}.onrender.com/{os.getenv('TELEGRAM_BOT_TOKEN')}"
-        )
+        url_path = os.getenv('TELEGRAM_BOT_TOKEN')
+        webhook_url = f"https://{os.getenv('RENDER_SERVICE_NAME')}.onrender.com/{url_path}"
+        secret_token = webhook_secret_token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        asyncio.run(run_webhook(application, url_path, webhook_url, secret_token))
             
     except Exception as e:
         logger.error(f"Ошибка запуска: {e}")
 
+    if db.warm_up_failed:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""Выгрузка сообщений и ответов психолога для отчетов.
+
+Читает messages (и по умолчанию messages_archive) вместе с данными пользователя
+серверным курсором и пишет CSV или JSONL пачками, поэтому расход памяти не
+зависит от размера таблиц.
+
+Пример:
+    DATABASE_URL=postgresql://localhost/bot python export.py --format csv \\
+        --from 2026-01-01 --to 2026-02-01 --unanswered -o january.csv
+"""
+import argparse
+import csv
+import datetime
+import json
+import sys
+
+import bot
+
+COLUMNS = (
+    "id", "message_id", "user_id", "user_message_id", "message_type", "text",
+    "created_at", "answered", "response", "response_type", "archived",
+    "user_created_at", "answers_count", "last_answered_at",
+)
+# SQLite возвращает логические значения как 0/1 — приводим, чтобы выгрузка не зависела от хранилища
+BOOLEAN_COLUMNS = {"answered", "archived"}
+
+
+def parse_date(value):
+    return datetime.date.fromisoformat(value)
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"Не удается сериализовать {type(value).__name__}")
+
+
+def row_values(row):
+    return {
+        column: bool(row[column]) if column in BOOLEAN_COLUMNS and row[column] is not None else row[column]
+        for column in COLUMNS
+    }
+
+
+def write_csv(batches, output):
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    count = 0
+    for rows in batches:
+        writer.writerows(row_values(row).values() for row in rows)
+        count += len(rows)
+    return count
+
+
+def write_jsonl(batches, output):
+    count = 0
+    for rows in batches:
+        output.writelines(
+            json.dumps(row_values(row), ensure_ascii=False, default=json_default) + "\n"
+            for row in rows
+        )
+        count += len(rows)
+    return count
+
+
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка сообщений и ответов в CSV/JSONL")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv", help="формат выгрузки")
+    parser.add_argument("-o", "--output", default="-", help="файл выгрузки (по умолчанию stdout)")
+    parser.add_argument("--from", dest="date_from", type=parse_date, default=None,
+                        help="с даты включительно, ГГГГ-ММ-ДД")
+    parser.add_argument("--to", dest="date_to", type=parse_date, default=None,
+                        help="по дату не включительно, ГГГГ-ММ-ДД")
+    status = parser.add_mutually_exclusive_group()
+    status.add_argument("--answered", dest="answered", action="store_const", const=True,
+                        help="только сообщения с ответом психолога")
+    status.add_argument("--unanswered", dest="answered", action="store_const", const=False,
+                        help="только сообщения без ответа")
+    parser.add_argument("--no-archive", dest="include_archive", action="store_false",
+                        help="не выгружать сообщения из messages_archive")
+    parser.add_argument("--batch-size", type=int, default=1000, help="строк за одно чтение курсора")
+    args = parser.parse_args()
+
+    # Только чтение: миграции применяет бот, отчетный скрипт схему не меняет
+    if not bot.db.connect():
+        sys.exit("Не удалось подключиться к базе данных")
+    if not bot.db.check_schema():
+        bot.db.close()
+        sys.exit("Схема базы данных не соответствует версии бота")
+
+    batches = bot.db.iter_messages(
+        date_from=args.date_from,
+        date_to=args.date_to,
+        answered=args.answered,
+        include_archive=args.include_archive,
+        batch_size=args.batch_size,
+    )
+    output = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    try:
+        count = WRITERS[args.format](batches, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        bot.db.close()
+    bot.logger.info(f"Выгружено сообщений: {count}")
+
+
+if __name__ == "__main__":
+    main()